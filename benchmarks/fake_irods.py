@@ -0,0 +1,328 @@
+"""Local stand-in for an iRODS server, to benchmark the pipeline without a live server.
+FakeSession replaces ibridges.Session, the real ibridges IrodsPath works on top of it. Collections are
+folders and data objects are files below a local root folder, the metadata of a data object is stored
+as json in a separate folder. Every catalog call waits the configured latency and the data streams are
+limited to the configured bandwidth, so network bound runs can be simulated on a laptop.
+The settings come from the iRODS environment, which the benchmark writes like a normal environment file:
+    fake_root: str
+        folder that plays the iRODS zone
+    fake_latency: float
+        seconds per catalog call, open, close or checksum
+    fake_bandwidth: int
+        bytes per second per data object stream, 0 is unlimited
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import shutil
+from pathlib import Path
+from time import sleep
+
+from irods.meta import iRODSMeta
+from irods.models import Collection, DataObject, DataObjectMeta
+
+REPLICA_GOOD = '1'
+
+
+class FakeIrods:
+    """Catalog and storage of the fake server, shared by all sessions through the filesystem"""
+    def __init__(self, root: str, latency: float = 0.0, bandwidth: int = 0):
+        self.root = Path(root)
+        self.data_root = self.root.joinpath('data')
+        self.meta_root = self.root.joinpath('meta')
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def wait(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def local(self, irods_path: str) -> Path:
+        return self.data_root.joinpath(str(irods_path).lstrip('/'))
+
+    def meta_file(self, irods_path: str) -> Path:
+        return self.meta_root.joinpath(str(irods_path).lstrip('/') + '.json')
+
+    def read_avus(self, irods_path: str) -> list:
+        meta_file = self.meta_file(irods_path)
+        if not meta_file.exists():
+            return []
+        with open(meta_file, 'r', encoding='UTF-8') as file:
+            return [iRODSMeta(*avu) for avu in json.load(file)]
+
+    def write_avus(self, irods_path: str, avus: list):
+        meta_file = self.meta_file(irods_path)
+        meta_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = meta_file.with_name(meta_file.name + '.tmp')
+        with open(temp_file, 'w', encoding='UTF-8') as file:
+            json.dump([[avu.name, avu.value, avu.units] for avu in avus], file)
+        os.replace(temp_file, meta_file)
+
+    def add_avu(self, irods_path: str, name: str, value: str, units: str = None):
+        self.write_avus(irods_path, self.read_avus(irods_path) + [iRODSMeta(name, value, units)])
+
+
+class ThrottledFile:
+    """Data object stream on a local file, limited to the bandwidth of the fake server"""
+    def __init__(self, irods: FakeIrods, file):
+        self.irods = irods
+        self.file = file
+
+    def throttle(self, size: int):
+        if self.irods.bandwidth:
+            sleep(size / self.irods.bandwidth)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.throttle(len(data))
+        return data
+
+    def write(self, data) -> int:
+        self.throttle(len(data))
+        return self.file.write(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def readable(self) -> bool:
+        return self.file.readable()
+
+    def writable(self) -> bool:
+        return self.file.writable()
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        if not self.file.closed:
+            self.irods.wait()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeMetadata:
+    """Metadata manager of a data object"""
+    def __init__(self, irods: FakeIrods, irods_path: str):
+        self.irods = irods
+        self.irods_path = irods_path
+
+    def items(self) -> list:
+        self.irods.wait()
+        return self.irods.read_avus(self.irods_path)
+
+    def add(self, name: str, value: str, units: str = None):
+        self.irods.wait()
+        self.irods.add_avu(self.irods_path, name, value, units)
+
+    def apply_atomic_operations(self, *operations):
+        self.irods.wait()
+        avus = self.irods.read_avus(self.irods_path)
+        for operation in operations:
+            if operation.operation == 'add':
+                avus.append(operation.avu)
+            else:
+                avus = [avu for avu in avus if (avu.name, avu.value) != (operation.avu.name, operation.avu.value)]
+        self.irods.write_avus(self.irods_path, avus)
+
+
+class FakeDataObject:
+    def __init__(self, irods: FakeIrods, irods_path: str):
+        self.path = irods_path
+        self.name = posixpath.basename(irods_path)
+        self.size = irods.local(irods_path).stat().st_size
+        self.replicas = [FakeReplica(self.size)]
+        self.metadata = FakeMetadata(irods, irods_path)
+
+
+class FakeReplica:
+    def __init__(self, size: int):
+        self.number = 0
+        self.resource_name = 'benchmark'
+        self.checksum = None
+        self.size = size
+        self.status = REPLICA_GOOD
+
+
+class FakeDataObjectManager:
+    def __init__(self, irods: FakeIrods):
+        self.irods = irods
+
+    def exists(self, path: str) -> bool:
+        self.irods.wait()
+        return self.irods.local(path).is_file()
+
+    def get(self, path: str) -> FakeDataObject:
+        self.irods.wait()
+        if not self.irods.local(path).is_file():
+            raise FileNotFoundError(f"Data object {path} does not exist")
+        return FakeDataObject(self.irods, path)
+
+    def open(self, path: str, mode: str = 'r', **options) -> ThrottledFile:
+        self.irods.wait()
+        local = self.irods.local(path)
+        if not local.parent.is_dir():
+            raise FileNotFoundError(f"Collection of {path} does not exist")
+        return ThrottledFile(self.irods, open(local, {'r': 'rb', 'r+': 'r+b', 'w': 'wb', 'a': 'ab'}[mode]))
+
+    def move(self, source: str, target: str):
+        self.irods.wait()
+        os.replace(self.irods.local(source), self.irods.local(target))
+        if self.irods.meta_file(source).exists():
+            self.irods.meta_file(target).parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self.irods.meta_file(source), self.irods.meta_file(target))
+
+    def unlink(self, path: str, force: bool = False, **options):
+        self.irods.wait()
+        self.irods.local(path).unlink()
+        if self.irods.meta_file(path).exists():
+            self.irods.meta_file(path).unlink()
+
+    def chksum(self, path: str, **options) -> str:
+        """The server reads the data object, which is not limited by the bandwidth"""
+        self.irods.wait()
+        digest = hashlib.sha256()
+        with open(self.irods.local(path), 'rb') as file:
+            while chunk := file.read(2**22):
+                digest.update(chunk)
+        return 'sha2:' + base64.b64encode(digest.digest()).decode()
+
+
+class FakeCollectionManager:
+    def __init__(self, irods: FakeIrods):
+        self.irods = irods
+
+    def exists(self, path: str) -> bool:
+        self.irods.wait()
+        return self.irods.local(path).is_dir()
+
+    def create(self, path: str):
+        self.irods.wait()
+        self.irods.local(path).mkdir(parents=True, exist_ok=True)
+
+
+class FakeQuery:
+    """The general queries of ioperations: data objects, their replicas or metadata, and collections,
+    filtered on the collection name (= and like 'name/%'), the parent collection and the metadata name"""
+    def __init__(self, irods: FakeIrods, columns: tuple, criteria: tuple = (), max_rows: int = None):
+        self.irods = irods
+        self.columns = columns
+        self.criteria = criteria
+        self.max_rows = max_rows
+
+    def filter(self, *criteria):
+        return FakeQuery(self.irods, self.columns, self.criteria + criteria, self.max_rows)
+
+    def limit(self, max_rows: int):
+        return FakeQuery(self.irods, self.columns, self.criteria, max_rows)
+
+    def collections(self) -> list:
+        """iRODS paths of the collections that match the criteria on the collection"""
+        collections = [posixpath.sep]
+        for criterion in self.criteria:
+            key = criterion.query_key.icat_key
+            if key == Collection.name.icat_key and criterion.op == '=':
+                collections = [criterion.value]
+            elif key == Collection.name.icat_key and criterion.op == 'like':
+                # Like in SQL, _ matches any character and % any string, also in the collection name
+                pattern = re.compile(''.join('.' if char == '_' else '.*' if char == '%' else re.escape(char)
+                                             for char in criterion.value))
+                parent = posixpath.dirname(re.split('[_%]', criterion.value, 1)[0])
+                local = self.irods.local(parent)
+                candidates = [posixpath.join(parent, path.relative_to(local).as_posix())
+                              for path in local.rglob('*') if path.is_dir()] if local.is_dir() else []
+                collections = [collection for collection in candidates if pattern.fullmatch(collection)]
+            elif key == Collection.parent_name.icat_key:
+                local = self.irods.local(criterion.value)
+                collections = [posixpath.join(criterion.value, path.name)
+                               for path in local.iterdir() if path.is_dir()] if local.is_dir() else []
+        return [collection for collection in collections if self.irods.local(collection).is_dir()]
+
+    def rows(self):
+        keys = {column.icat_key for column in self.columns}
+        meta_names = [criterion.value for criterion in self.criteria
+                      if criterion.query_key.icat_key == DataObjectMeta.name.icat_key]
+        for collection in self.collections():
+            if not keys & {DataObject.name.icat_key, DataObjectMeta.value.icat_key}:
+                yield {Collection.name: collection, Collection.id: 0}
+                continue
+            for path in sorted(self.irods.local(collection).iterdir()):
+                if not path.is_file():
+                    continue
+                row = {Collection.name: collection, DataObject.name: path.name,
+                       DataObject.size: str(path.stat().st_size), DataObject.replica_status: REPLICA_GOOD}
+                if DataObjectMeta.value.icat_key not in keys:
+                    yield row
+                    continue
+                for avu in self.irods.read_avus(posixpath.join(collection, path.name)):
+                    if not meta_names or avu.name in meta_names:
+                        yield {**row, DataObjectMeta.name: avu.name, DataObjectMeta.value: avu.value}
+
+    def all(self) -> list:
+        self.irods.wait()
+        rows = list(self.rows())
+        return rows[:self.max_rows] if self.max_rows is not None else rows
+
+    def __iter__(self):
+        return iter(self.all())
+
+
+class FakeiRODSSession:
+    """The parts of irods.session.iRODSSession that are used by the pipeline"""
+    def __init__(self, irods: FakeIrods):
+        self.irods = irods
+        self.data_objects = FakeDataObjectManager(irods)
+        self.collections = FakeCollectionManager(irods)
+
+    def query(self, *columns) -> FakeQuery:
+        return FakeQuery(self.irods, columns)
+
+    def cleanup(self):
+        pass
+
+
+class FakeSession:
+    """Drop in for ibridges.Session"""
+    def __init__(self, irods_env: dict, password: str = None, irods_home: str = None, cwd: str = None):
+        self.irods = FakeIrods(irods_env['fake_root'], irods_env.get('fake_latency', 0.0),
+                               irods_env.get('fake_bandwidth', 0))
+        self.irods.wait()
+        self.irods_session = FakeiRODSSession(self.irods)
+        self.home = irods_home or f"/{irods_env.get('irods_zone_name', 'benchZone')}/home/" \
+                                  f"{irods_env.get('irods_user_name', 'bench')}"
+        self.cwd = cwd or self.home
+        self.server_version = (4, 3, 0)
+
+    def close(self):
+        pass
+
+
+def fake_execute_rule(session: FakeSession, rule_file, body: str = '', params: dict = None, **kwargs) -> tuple:
+    """Stand-in for the archive rule, the data object is archived right away"""
+    session.irods.wait()
+    irods_path = params['*file_or_collection']
+    session.irods.add_avu(irods_path, 'archive_status', 'completed_and_hot_deleted')
+    return f"{irods_path} will be tagged.", ""
+
+
+def reset(root: str, collections: list):
+    """Empty the fake server and create the given collections"""
+    shutil.rmtree(root, ignore_errors=True)
+    irods = FakeIrods(root)
+    irods.meta_root.mkdir(parents=True)
+    for collection in collections:
+        irods.local(collection).mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,150 @@
+"""Benchmark scenarios that run the real pipeline of main.py against the local iRODS stand-in of fake_irods.py:
+create_task_df, the zippers, the iRODS workers, the metadata and the tape rule. The timings per stage come
+from the metrics of the run, they are printed per scenario and kept in <workdir>/<scenario>/metrics.json.
+The fake session is patched into the modules before main.py starts its workers, which inherit it through
+fork, so the benchmarks run on Linux and macOS but not on Windows.
+
+    python benchmarks/run.py --workdir /tmp/ingest_bench --latency 0.005 --bandwidth 100MB zip per-file
+"""
+import argparse
+import getpass
+import json
+import multiprocessing
+import runpy
+import shutil
+import sys
+from pathlib import Path
+from time import time
+
+BENCH_DIR = Path(__file__).resolve().parent
+CODE_DIR = BENCH_DIR.parent.joinpath('iRODS_ingest')
+sys.path.insert(0, str(CODE_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+import fake_irods  # noqa: E402
+from tree import generate_tree  # noqa: E402
+from utils import parse_filesize  # noqa: E402
+
+TARGET_COLLECTION = '/benchZone/home/bench/ingest'
+
+# Source trees, scaled by --scale
+TREES = {
+    'small-files': dict(folders=4, subfolders=8, files_per_folder=2000, file_size=32 * 2**10),
+    'huge-files': dict(folders=0, files_per_folder=0, huge_files=4, huge_size=512 * 2**20),
+    'mixed': dict(folders=4, subfolders=4, files_per_folder=500, file_size=256 * 2**10,
+                  huge_files=2, huge_size=256 * 2**20),
+}
+
+# Scenario: tree and the config settings that differ from the defaults
+SCENARIOS = {
+    'zip': ('small-files', {'ZIP_FOLDERS': True}),
+    'stream': ('small-files', {'ZIP_FOLDERS': True, 'ZIP_STREAM': True}),
+    'per-file': ('small-files', {'ZIP_FOLDERS': False}),
+    'bundled': ('small-files', {'ZIP_FOLDERS': False, 'BUNDLE_FILE_LIMIT': '1MB', 'BUNDLE_SIZE': '64MB'}),
+    'huge-files': ('huge-files', {'ZIP_FOLDERS': True}),
+    'mixed': ('mixed', {'ZIP_FOLDERS': True}),
+}
+
+
+def scale_tree(settings: dict, scale: float) -> dict:
+    scaled = dict(settings)
+    for key in ['files_per_folder', 'huge_size']:
+        if key in scaled:
+            scaled[key] = int(scaled[key] * scale)
+    return scaled
+
+
+def write_config(scenario_dir: Path, source_dir: Path, irods_root: Path, args, overrides: dict) -> Path:
+    """Write the iRODS environment of the fake server and the config of a scenario
+    Returns:
+        Path: the config file
+    """
+    env_path = scenario_dir.joinpath('irods_environment.json')
+    env_path.write_text(json.dumps({'irods_zone_name': 'benchZone', 'irods_user_name': 'bench',
+                                    'fake_root': str(irods_root), 'fake_latency': args.latency,
+                                    'fake_bandwidth': parse_filesize(args.bandwidth)}))
+    zip_dir = scenario_dir.joinpath('zips')
+    zip_dir.mkdir()
+    config = {'SMB_MOUNT': False, 'ZIP_FOLDERS': True, 'ZIP_SPLIT_ABOVE_5TB': True, 'TO_TAPE': True,
+              'NUM_ZIPPERS': args.zippers, 'NUM_IWORKERS': args.iworkers, 'METRICS_INTERVAL': 5,
+              'IRODS_ENV_FILE': str(env_path), 'LOCAL_SOURCE_PATH': str(source_dir),
+              'LOCAL_ZIP_TEMP': str(zip_dir), 'LOCAL_ZIP_SPACE': args.zip_space,
+              'IRODS_TARGET_PATH': TARGET_COLLECTION, 'METADATA_EXCEL': 'metadata.xlsx',
+              'PROGRESS_FILE': str(scenario_dir.joinpath('progress.csv'))}
+    config.update(overrides)
+    config_path = scenario_dir.joinpath('config.json')
+    config_path.write_text(json.dumps(config, indent=4))
+    return config_path
+
+
+def run_pipeline(config_path: Path):
+    """Run main.py with the fake iRODS server, in a separate process"""
+    multiprocessing.set_start_method('fork', force=True)
+    import ioperations
+    ioperations.Session = fake_irods.FakeSession
+    ioperations.execute_rule = fake_irods.fake_execute_rule
+    getpass.getpass = lambda prompt='': ''
+    sys.argv = ['main.py', '--config', str(config_path)]
+    runpy.run_path(str(CODE_DIR.joinpath('main.py')), run_name='__main__')
+
+
+def run_scenario(name: str, args) -> dict:
+    """Run a scenario on a fresh fake server and progress state
+    Returns:
+        dict: wall time, exit code and the metrics of the run
+    """
+    tree_name, overrides = SCENARIOS[name]
+    source_dir = Path(args.workdir).joinpath('trees', tree_name)
+    generate_tree(source_dir, **scale_tree(TREES[tree_name], args.scale))
+    scenario_dir = Path(args.workdir).joinpath(name)
+    shutil.rmtree(scenario_dir, ignore_errors=True)
+    scenario_dir.mkdir(parents=True)
+    irods_root = Path(args.workdir).joinpath('irods')
+    fake_irods.reset(str(irods_root), [TARGET_COLLECTION])
+    config_path = write_config(scenario_dir, source_dir, irods_root, args, overrides)
+
+    metrics_path = CODE_DIR.joinpath('logs', 'metrics.json')
+    if metrics_path.exists():
+        metrics_path.unlink()
+    start_time = time()
+    process = multiprocessing.get_context('fork').Process(target=run_pipeline, args=(config_path,))
+    process.start()
+    process.join()
+    result = {'scenario': name, 'wall_seconds': time() - start_time, 'exitcode': process.exitcode, 'stages': {}}
+    if metrics_path.exists():
+        shutil.copy(metrics_path, scenario_dir.joinpath('metrics.json'))
+        result['stages'] = json.loads(metrics_path.read_text())['stages']
+    return result
+
+
+def print_results(results: list):
+    print(f"{'scenario':<12} {'stage':<10} {'items':>7} {'GB':>8} {'MB/s':>9} {'MB/s/worker':>12} {'busy s':>9}")
+    for result in results:
+        status = '' if result['exitcode'] == 0 else f" (failed, exit code {result['exitcode']})"
+        print(f"{result['scenario']:<12} {'total':<10} {'':>7} {'':>8} {'':>9} {'':>12} "
+              f"{result['wall_seconds']:>9.1f}{status}")
+        for stage, values in result['stages'].items():
+            print(f"{'':<12} {stage:<10} {values['items']:>7} {values['bytes'] / 2**30:>8.2f} "
+                  f"{values['bytes_per_second'] / 2**20:>9.1f} {values['bytes_per_second_per_worker'] / 2**20:>12.1f} "
+                  f"{values['busy_seconds']:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline against a local iRODS stand-in.")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help=f"Scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument('--workdir', type=str, default='bench_output', help='Folder for the trees and the runs')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of files and their size')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per iRODS call')
+    parser.add_argument('--bandwidth', type=str, default='0', help='Bytes per second per stream, e.g. 100MB')
+    parser.add_argument('--zippers', type=int, default=2, help='NUM_ZIPPERS')
+    parser.add_argument('--iworkers', type=int, default=2, help='NUM_IWORKERS')
+    parser.add_argument('--zip-space', type=str, default='100GB', help='LOCAL_ZIP_SPACE')
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = [run_scenario(name, args) for name in args.scenarios]
+    print_results(results)
+    Path(args.workdir).joinpath('results.json').write_text(json.dumps(results, indent=2))
@@ -0,0 +1,90 @@
+"""Synthetic source trees for the benchmarks: folders with many small files, a few huge files and a mix of
+compressible and incompressible data, with the metadata Excel that main.py reads."""
+import json
+import random
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+WORDS = [b'plant', b'leaf', b'root', b'camera', b'sensor', b'greenhouse', b'climate', b'cell', b'image', b'0.25']
+CHUNK_SIZE = 4 * 2**20
+
+
+def text_block(rng: random.Random) -> bytes:
+    """A chunk of text like data, rotated for every chunk of a compressible file"""
+    return b' '.join(rng.choice(WORDS) for _ in range(CHUNK_SIZE // 5))[:CHUNK_SIZE]
+
+
+def write_file(path: Path, size: int, compressible: bool, rng: random.Random, text: bytes):
+    """Write a file of size bytes, text like data that deflates well or random data that does not"""
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            length = min(CHUNK_SIZE, size - written)
+            if compressible:
+                offset = rng.randrange(CHUNK_SIZE)
+                data = (text[offset:] + text[:offset])[:length]
+            else:
+                data = rng.randbytes(length)
+            file.write(data)
+            written += length
+
+
+def generate_tree(root: Path, folders: int = 4, subfolders: int = 4, files_per_folder: int = 1000,
+                  file_size: int = 64 * 2**10, huge_files: int = 0, huge_size: int = 2**30,
+                  compressible: float = 0.5, seed: int = 0) -> Path:
+    """Generate a source tree, an existing tree with the same settings is reused
+    Args:
+        root: Path
+            folder of the tree, the metadata Excel is written in it
+        folders: int
+            number of folders, every folder is a row in the Excel
+        subfolders: int
+            subfolders per folder, the files are spread over them
+        files_per_folder: int
+            number of small files per folder
+        file_size: int
+            average size of the small files, the sizes vary from half to one and a half times this
+        huge_files: int
+            number of huge files, every file is a row in the Excel
+        huge_size: int
+            size of the huge files
+        compressible: float
+            fraction of the files with compressible content
+        seed: int
+            seed of the content and the sizes
+    Returns:
+        Path: the metadata Excel
+    """
+    settings = dict(folders=folders, subfolders=subfolders, files_per_folder=files_per_folder,
+                    file_size=file_size, huge_files=huge_files, huge_size=huge_size,
+                    compressible=compressible, seed=seed)
+    root = Path(root)
+    excel_path = root.joinpath('metadata.xlsx')
+    settings_path = root.joinpath('tree.json')
+    if settings_path.exists() and json.loads(settings_path.read_text()) == settings:
+        return excel_path
+    shutil.rmtree(root, ignore_errors=True)
+    root.mkdir(parents=True)
+    rng = random.Random(seed)
+    text = text_block(rng)
+
+    rows = []
+    for i in range(folders):
+        folder = root.joinpath(f"folder_{i:03d}")
+        for j in range(files_per_folder):
+            subfolder = folder.joinpath(f"sub_{j % max(subfolders, 1):02d}") if subfolders else folder
+            subfolder.mkdir(parents=True, exist_ok=True)
+            size = rng.randint(file_size // 2, file_size * 3 // 2)
+            write_file(subfolder.joinpath(f"file_{j:06d}.dat"), size, rng.random() < compressible, rng, text)
+        rows.append(folder.name)
+    for i in range(huge_files):
+        path = root.joinpath(f"huge_{i:03d}.dat")
+        write_file(path, huge_size, rng.random() < compressible, rng, text)
+        rows.append(path.name)
+
+    pd.DataFrame({'Foldername': rows, 'Year': 2024, 'NPEC Module': 'Greenhouse', 'System': 'Benchmark',
+                  'Comment': 'synthetic benchmark data', '_to_upload': 'v'}).to_excel(excel_path, index=False)
+    settings_path.write_text(json.dumps(settings))
+    return excel_path
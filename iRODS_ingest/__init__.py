@@ -1 +1,11 @@
 FIVE_TB_FILE_LIMIT = 5 * 10 ** 12
+
+# Events the workers send to the coordinator, as (event, worker id, row)
+ZIPPED = 'zipped'
+UPLOADED = 'uploaded'
+FILES_UPLOADED = 'files uploaded'
+UPLOAD_PROGRESS = 'upload progress'
+ZIPPER_STOPPED = 'zipper stopped'
+IWORKER_STOPPED = 'iworker stopped'
+PLANNED = 'planned'
+PLANNER_STOPPED = 'planner stopped'
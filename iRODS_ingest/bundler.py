@@ -0,0 +1,61 @@
+import csv
+import io
+
+# Subcollection of an uploaded folder that holds the bundles and their manifest
+BUNDLE_COLLECTION = '_bundles'
+MANIFEST_NAME = 'manifest.csv'
+
+
+def plan_bundles(files: list, file_limit: int, bundle_size: int) -> tuple:
+    """Split the files of a folder in files that are uploaded on their own and bundles of small files.
+    The files are taken in order, so the files of a subfolder end up in the same bundles, and the same
+    folder always gives the same bundles which allows an interrupted upload to continue.
+    Args:
+        files: list
+            sorted (relative path, size) of the files, e.g. ScanResult.files
+        file_limit: int
+            files smaller than this are bundled
+        bundle_size: int
+            maximum size of the files in a bundle, a bundle has at least one file
+    Returns:
+        tuple: list of (relative path, size) of the big files, list of bundles as lists of (relative path, size)
+    """
+    big_files = []
+    bundles = []
+    bundle = []
+    size_in_bundle = 0
+    for rel_path, size in files:
+        if size >= file_limit:
+            big_files.append((rel_path, size))
+            continue
+        if bundle and size_in_bundle + size > bundle_size:
+            bundles.append(bundle)
+            bundle = []
+            size_in_bundle = 0
+        bundle.append((rel_path, size))
+        size_in_bundle += size
+    if bundle:
+        bundles.append(bundle)
+    return big_files, bundles
+
+
+def bundle_name(index: int) -> str:
+    """Name of the zip of a bundle"""
+    return f"bundle_{index + 1:05d}.zip"
+
+
+def create_manifest(bundles: list) -> bytes:
+    """Manifest of the bundles, a csv with the original path of every bundled file and its bundle
+    Args:
+        bundles: list
+            bundles as returned by plan_bundles
+    Returns:
+        bytes: content of the csv
+    """
+    manifest = io.StringIO()
+    writer = csv.writer(manifest, lineterminator='\n')
+    writer.writerow(['path', 'bundle'])
+    for index, bundle in enumerate(bundles):
+        for rel_path, _ in bundle:
+            writer.writerow([rel_path, f"{BUNDLE_COLLECTION}/{bundle_name(index)}"])
+    return manifest.getvalue().encode('utf-8')
@@ -0,0 +1,110 @@
+import logging
+import multiprocessing
+import queue
+from time import time
+
+
+def retire_requested(retire_queue: multiprocessing.Queue) -> bool:
+    """Take a retire token, workers check this before they take a new job.
+    A token instead of a sentinel on the job queue, so a worker retires after its current job instead of
+    after all jobs that are queued already. A worker that waits for a job retires after that job.
+    Args:
+        retire_queue: multiprocessing.Queue
+            tokens of the coordinator, one token stops one worker. None when the worker count is fixed
+    Returns:
+        bool: True if the worker took a token and should stop
+    """
+    if retire_queue is None:
+        return False
+    try:
+        retire_queue.get_nowait()
+        return True
+    except queue.Empty:
+        return False
+
+
+class ProgressCounter:
+    """Bytes processed by the workers of a stage, shared with the coordinator. The workers add the bytes of every
+    block they zip or upload, so the controller also sees the progress of jobs that are still running, e.g. of a
+    big folder that takes longer than the interval"""
+    def __init__(self):
+        self.value = multiprocessing.Value('q', 0)
+
+    def add(self, num_bytes: int):
+        """Add bytes, called by the workers and their threads"""
+        with self.value.get_lock():
+            self.value.value += num_bytes
+
+    @property
+    def total(self) -> int:
+        """Bytes processed by the stage since the start"""
+        return self.value.value
+
+
+class ConcurrencyController:
+    """Additive increase, multiplicative decrease (AIMD) of the number of workers of a stage.
+    Every interval the bytes per second of the stage are compared with the previous interval. While jobs are
+    waiting and the throughput did not drop, one worker is added. When the throughput dropped after a worker
+    was added, e.g. because the uploaders fight over a saturated link or the zippers over the disk, the number
+    of workers is multiplied by the decrease factor. The number of workers stays between minimum and maximum.
+    """
+    def __init__(self, name: str, workers: int, minimum: int, maximum: int, interval: int = 600,
+                 tolerance: float = 0.05, decrease: float = 0.5):
+        """
+        Args:
+            name: str
+                stage, for the log
+            workers: int
+                number of workers at the start
+            minimum: int
+                lower bound of the number of workers
+            maximum: int
+                upper bound of the number of workers
+            interval: int
+                seconds between two adjustments, long enough to finish a few jobs
+            tolerance: float
+                relative change of the throughput that is seen as noise
+            decrease: float
+                factor of the number of workers when the throughput dropped
+        """
+        self.name = name
+        self.workers = workers
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.last_time = time()
+        self.last_bytes = 0
+        self.last_rate = None
+        self.increased = False
+
+    def update(self, total_bytes: int, backlog: bool) -> int:
+        """Adjust the number of workers once the interval passed, can be called as often as needed
+        Args:
+            total_bytes: int
+                bytes processed by the stage since the start, including the jobs that are running, see ProgressCounter
+            backlog: bool
+                jobs are waiting for a worker of the stage
+        Returns:
+            int: workers to add, negative to remove
+        """
+        now = time()
+        if now - self.last_time < self.interval:
+            return 0
+        rate = (total_bytes - self.last_bytes) / (now - self.last_time)
+        previous = self.last_rate
+        self.last_time, self.last_bytes, self.last_rate = now, total_bytes, rate
+        target = self.workers
+        if self.increased and previous is not None and rate < previous * (1 - self.tolerance):
+            # The extra worker made the stage slower, back off
+            target = max(self.minimum, int(self.workers * self.decrease))
+        elif backlog and (previous is None or rate >= previous * (1 - self.tolerance)):
+            target = min(self.maximum, self.workers + 1)
+        change = target - self.workers
+        self.increased = change > 0
+        if change != 0:
+            logging.info(f"{self.name}: {rate / 2**20:.1f}MB/s, was {(previous or 0) / 2**20:.1f}MB/s, "
+                         f"going from {self.workers} to {target} workers")
+        self.workers = target
+        return change
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+# Parquet is optional, without pyarrow the cache is a pickle
+try:
+    import pyarrow  # noqa: F401
+    CACHE_SUFFIX = '.parquet'
+except ImportError:
+    CACHE_SUFFIX = '.pkl'
+
+
+def file_hash(file_path: Path) -> str:
+    """SHA-256 of a file, read in blocks of 4MB"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while block := file.read(4 * 2**20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_upload_rows(excel_path: Path) -> pd.DataFrame:
+    """Read the rows with a 'v' in the '_to_upload' column of the first sheet.
+    The sheet is streamed row by row in read only mode, only the rows to upload are kept.
+    Args:
+        excel_path: Path
+            metadata Excel, the first row has the column names
+    Returns:
+        pd.DataFrame: rows to upload, the index is the row number below the header as with pd.read_excel
+    """
+    workbook = load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        columns = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+        if '_to_upload' not in columns:
+            logging.error(f"Column _to_upload is missing in {excel_path}")
+            exit(1)
+        to_upload = columns.index('_to_upload')
+        index = []
+        values = []
+        for ind, row in enumerate(rows):
+            if len(row) > to_upload and row[to_upload] == 'v':
+                index.append(ind)
+                values.append(row[:len(columns)] + (None,) * (len(columns) - len(row)))
+    finally:
+        workbook.close()
+    df = pd.DataFrame(values, index=index, columns=columns, dtype=object)
+    # Coerce the types once: empty cells become NaN, numbers and dates get their own dtype
+    return df.fillna(np.nan).infer_objects()
+
+
+def load_metadata_excel(excel_path: Path, cache_path: Path = None) -> pd.DataFrame:
+    """Load the rows to upload of the metadata Excel, from the cache if the Excel did not change.
+    The cache is a parquet file, or a pickle without pyarrow, with a json file next to it with the modification
+    time, size and SHA-256 of the Excel. When the modification time changed but the content did not, e.g. after
+    a copy, the cache is still used.
+    Args:
+        excel_path: Path
+            metadata Excel
+        cache_path: Path
+            optional, cache without suffix, None to always read the Excel
+    Returns:
+        pd.DataFrame: rows to upload, see read_upload_rows
+    """
+    if cache_path is None:
+        return read_upload_rows(excel_path)
+    stat = Path(excel_path).stat()
+    key = {'excel': str(excel_path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    key_path = cache_path.with_suffix('.json')
+    data_path = cache_path.with_suffix(CACHE_SUFFIX)
+    cached_key = json.loads(key_path.read_text()) if key_path.exists() and data_path.exists() else {}
+    if all(cached_key.get(name) == value for name, value in key.items()):
+        logging.info(f"Loaded the rows to upload from {data_path}")
+        return pd.read_parquet(data_path) if CACHE_SUFFIX == '.parquet' else pd.read_pickle(data_path)
+    key['sha256'] = file_hash(excel_path)
+    if cached_key.get('sha256') == key['sha256'] and cached_key.get('size') == key['size']:
+        df = pd.read_parquet(data_path) if CACHE_SUFFIX == '.parquet' else pd.read_pickle(data_path)
+    else:
+        start_time = datetime.now()
+        df = read_upload_rows(excel_path)
+        logging.info(f"Read {len(df)} rows to upload from {excel_path} in {datetime.now() - start_time}")
+        try:
+            if CACHE_SUFFIX == '.parquet':
+                df.to_parquet(data_path)
+            else:
+                df.to_pickle(data_path)
+        except (ValueError, TypeError) as e:
+            # e.g. a column with numbers and text, which parquet can't store
+            logging.warning(f"Could not cache the rows to upload in {data_path}: {e}")
+            return df
+    key_path.write_text(json.dumps(key))
+    return df
@@ -3,10 +3,10 @@ import re
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from ibridges import Session
 from ibridges.path import IrodsPath
 
 import utils as utils
+from ioperations import SessionPool
 
 
 def get_allowed_chars():
@@ -39,31 +39,34 @@ def check_paths(config: dict, password: str):
         logging.error('Source path does not exist')
         exit(1)
 
-    # If zipping check if the zip path exists
+    # If zipping check if the zip path exists, streamed zips don't use it
     zip_path = ""
-    if config['ZIP_FOLDERS']:
+    if config['ZIP_FOLDERS'] and not config.get('ZIP_STREAM', False):
         zip_path = Path(config['LOCAL_ZIP_TEMP'])
         if not zip_path.exists() or not zip_path.is_dir():
             logging.error("Zip path does not exist")
             exit(1)
 
-    # Check if target path exists
+    # Check if target path exists, with the session pool that is shared by all phases of the coordinator
     ienv = utils.load_json(env_file)
-    isession = Session(irods_env=ienv, password=password)
-    # Verification if a connection is made
-    isession.server_version
-
-    target_ipath = IrodsPath(isession, config['IRODS_TARGET_PATH'])
-    if not target_ipath.collection_exists():
-        logging.error('Target path does not exist')
-        exit(1)
-    return source_path, zip_path, target_ipath, ienv
+    session_pool = SessionPool(ienv, password, config.get('TAPE_THREADS', 4), config.get('SESSION_MAX_AGE', 3600))
+    with session_pool.session() as isession:
+        # Verification if a connection is made
+        isession.server_version
+
+        target_ipath = IrodsPath(isession, config['IRODS_TARGET_PATH'])
+        if not target_ipath.collection_exists():
+            logging.error('Target path does not exist')
+            exit(1)
+    return source_path, zip_path, target_ipath, ienv, session_pool
 
 
 def create_task_df(to_upload_df: pd.DataFrame, source_path: Path,
-                   target_ipath: Path, zip_path: Path, isession: Session):
+                   target_ipath: Path, zip_path: Path, stream_zip: bool = False):
     """ Create a task dataframe:
     Note, folder paths are incomplete, the zipper adds the missing parts
+    Only the checks that need no listing are done here, for all rows before anything is uploaded. Empty folders,
+    the sizes and the paths that exist in iRODS already are found by the planner while the workers run.
     Args:
         to_upload_df: pd.DataFrame
             DataFrame containing the metadata
@@ -73,14 +76,20 @@ def create_task_df(to_upload_df: pd.DataFrame, source_path: Path,
             Path to the target folder
         zip_path: Path
             Path to the zip folder
-        isession: Session
-            iRODS session
+        stream_zip: bool
+            folders are zipped straight into iRODS, without a local zip file
     Returns:
         to_upload_df: pd.DataFrame
             Added fields: _Path, _status, _zipPath, _iPath, _size
     """
     to_upload_df['_zipPath'] = ""
     to_upload_df['_size'] = np.nan
+    # All invalid rows are reported at once, so the sheet can be fixed in one go
+    errors = []
+    # Check if column names are valid sql identifiers, skip upload status columns
+    for col in to_upload_df.columns:
+        if col[0] != '_' and not check_sql_string(col):
+            errors.append(f"Invalid sql identifier: {col}")
     for ind, row in to_upload_df.iterrows():
         local_path = source_path.joinpath(row['Foldername'])
         if row['NPEC Module'] == 'ClimateCells':
@@ -90,49 +99,34 @@ def create_task_df(to_upload_df: pd.DataFrame, source_path: Path,
         elif row['NPEC Module'] == 'OpenField':
             ipath = target_ipath.joinpath('M6', row['System'], str(row['Year']))
         else:
-            logging.error(f"Unknown NPEC Module: {row['NPEC Module']} for file: {row['Foldername']}")
+            errors.append(f"Unknown NPEC Module: {row['NPEC Module']} for file: {row['Foldername']}")
+            continue
 
         to_upload_df.at[ind, '_Path'] = str(local_path)
         if local_path.is_dir():
-            # Check if the folder is empty
-            if not any(local_path.iterdir()):
-                to_upload_df.at[ind, '_status'] = 'Empty folder'
-                to_upload_df.at[ind, '_iPath'] = ""
+            to_upload_df.at[ind, '_status'] = 'Folder'
+            if zip_path != "":
+                to_upload_df.at[ind, '_zipPath'] = str(zip_path.joinpath(local_path.name + ".zip"))
+                to_upload_df.at[ind, '_iPath'] = str(ipath.joinpath(local_path.name + ".zip"))
+            elif stream_zip:
+                to_upload_df.at[ind, '_iPath'] = str(ipath.joinpath(local_path.name + ".zip"))
             else:
-                to_upload_df.at[ind, '_status'] = 'Folder'
-                if zip_path != "":
-                    to_upload_df.at[ind, '_zipPath'] = str(zip_path.joinpath(local_path.name + ".zip"))
-                    to_upload_df.at[ind, '_iPath'] = str(ipath.joinpath(local_path.name + ".zip"))
-                else:
-                    to_upload_df.at[ind, '_iPath'] = str(ipath)
+                to_upload_df.at[ind, '_iPath'] = str(ipath)
         elif local_path.is_file():
             to_upload_df.at[ind, '_status'] = 'File'
             to_upload_df.at[ind, '_iPath'] = str(ipath.joinpath(local_path.name))
         else:
-            logging.error(f"Path is not a file or folder: {local_path}")
-            exit(1)
+            errors.append(f"Path is not a file or folder: {local_path}")
+            continue
         # check for invallid irods paths
         if not verify_filename(to_upload_df.at[ind, '_iPath']):
-            logging.error(f"Invalid iRODS path at index {ind}: {to_upload_df.at[ind, '_iPath']},\
+            errors.append(f"Invalid iRODS path at index {ind}: {to_upload_df.at[ind, '_iPath']},\
                            for file: {row['Foldername']}. Only {get_allowed_chars()} are allowed")
-            exit(1)
-        # Check if column names are valid sql identifiers
-        for col in row.keys():
-            # Skip upload status columns
-            if col[0] == '_':
-                continue
-            elif not check_sql_string(col):
-                logging.error(f"Invalid sql identifier at index {ind}: {col}, for file: {row['Foldername']}")
-                exit(1)
-
-        # Check if file already exists, if not add it to the right queue
-        irods_path = IrodsPath(isession, to_upload_df.at[ind, '_iPath'])
-        if (to_upload_df.at[ind, '_zipPath'] or to_upload_df.at[ind, '_status'] == 'File') and irods_path.dataobject_exists():
-            logging.info(f"File already exists: {to_upload_df.at[ind, '_iPath']}")
-            to_upload_df.at[ind, '_status'] = 'existing ipath'
-        elif to_upload_df.at[ind, '_status'] == 'Folder' and irods_path.collection_exists():
-            logging.info(f"Folder already exist: {to_upload_df.at[ind, '_iPath']}")
-            to_upload_df.at[ind, '_status'] = 'existing ipath'
+    if errors:
+        for error in errors:
+            logging.error(error)
+        logging.error(f"Found {len(errors)} errors in the metadata, exiting")
+        exit(1)
     return to_upload_df
 
 
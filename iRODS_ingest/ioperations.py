@@ -1,31 +1,208 @@
 # iBridges operations
 import logging
 import multiprocessing
+import posixpath
 import pandas as pd
+import queue
+import re
+import signal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from time import time
 from pathlib import Path
 from ibridges import Session
-from ibridges.data_operations import create_collection, upload
+from ibridges.data_operations import create_collection
 from ibridges.meta import MetaData
 from ibridges.util import get_dataobject, obj_replicas
 from ibridges.rules import execute_rule
 from ibridges.path import IrodsPath
+from irods.column import Like
+from irods.exception import NetworkException
+from irods.meta import AVUOperation, iRODSMeta
+from irods.models import Collection, DataObject, DataObjectMeta
 
+from __init__ import FIVE_TB_FILE_LIMIT, UPLOADED, FILES_UPLOADED, UPLOAD_PROGRESS, IWORKER_STOPPED
+from controller import ProgressCounter, retire_requested
+from bundler import BUNDLE_COLLECTION, MANIFEST_NAME, plan_bundles, bundle_name, create_manifest
+from scanner import ScanResult, scan_folder
+from zipwriter import ConcatReader, Digest, SplitWriter, checksum_schemes, irods_checksum, is_complete_archive, \
+    zip_folder, summarize_methods, verify_archive, write_crc_report
 
-def add_metadata(session, row):
-    """Add metdata to an irods dataobject
+
+REPLICA_STATES = {'0': 'stale', '1': 'good', '2': 'intermediate', '3': 'read-locked', '4': 'write-locked'}
+UPLOAD_CHUNK_SIZE = 8 * 2**20
+UPLOAD_RETRIES = 3
+UPLOAD_CHECKPOINT_SIZE = 2**30
+
+
+class SessionPool:
+    """Pool of iRODS sessions for the threads of a process, every thread uses its own session while it has it
+    checked out. Sessions are created when needed, up to the maximum size of the pool.
+    On checkout a session older than max_age is replaced, and a session that was idle for more than check_after
+    seconds is checked with a small query and replaced when that fails, e.g. after a server timeout.
+    A session that failed with a connection error is closed, its replacement is created on the next checkout."""
+    def __init__(self, ienv: dict, password: str, size: int, max_age: int = 3600, check_after: int = 60):
+        self.ienv = ienv
+        self.password = password
+        self.max_age = max_age
+        self.check_after = check_after
+        # (session, created, last used), empty slots have no session yet. Last in first out, so the sessions
+        # are only created when the threads need them
+        self.sessions = queue.LifoQueue()
+        for i in range(0, size):
+            self.sessions.put((None, 0, 0))
+
+    @staticmethod
+    def is_healthy(session: Session) -> bool:
+        """Check the connection with a small query"""
+        try:
+            session.irods_session.query(Collection.id).limit(1).all()
+            return True
+        except Exception as e:
+            logging.info(f"iRODS session failed the health check, reconnecting: {e}")
+            return False
+
+    @staticmethod
+    def discard(session: Session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def connect(self, session: Session, created: float, last_used: float) -> tuple:
+        """Reuse, or replace, the session of a slot
+        Returns:
+            tuple: usable session, creation time
+        """
+        now = time()
+        if session is not None and now - created > self.max_age:
+            logging.info(f"Replacing an iRODS session older than {self.max_age} seconds")
+            self.discard(session)
+            session = None
+        elif session is not None and now - last_used > self.check_after and not self.is_healthy(session):
+            self.discard(session)
+            session = None
+        if session is None:
+            session = Session(irods_env=self.ienv, password=self.password)
+            created = now
+        return session, created
+
+    @contextmanager
+    def session(self):
+        """Check out a session for the duration of the with block"""
+        session, created, last_used = self.sessions.get()
+        try:
+            session, created = self.connect(session, created, last_used)
+        except BaseException:
+            self.sessions.put((None, 0, 0))
+            raise
+        try:
+            yield session
+        except (NetworkException, OSError):
+            # Broken connection, reconnect on the next checkout
+            self.discard(session)
+            session = None
+            raise
+        finally:
+            self.sessions.put((session, created, time()))
+
+    def close(self):
+        while not self.sessions.empty():
+            session, _, _ = self.sessions.get()
+            if session is not None:
+                self.discard(session)
+
+
+def get_archive_states(session, collection: str) -> dict:
+    """Get the archive status and the replica states of all data objects in a collection,
+    with one catalog query for each instead of two round trips per data object
     Args:
         session (ibridges.Session): irods session
-        row (dict): metadata to add
+        collection (str): absolute path of the collection
     Returns:
-        bool: True if successful
+        dict: data object name: (archive_status or None, set of replica states)
     """
-    i_path = IrodsPath(session, row['_iPath'])
-    if not i_path.dataobject_exists():
-        logging.error(f"Adding metadata, data object {i_path} not found")
-        return False
-    do = get_dataobject(session, i_path)
-    obj_meta = MetaData(do)
+    states = {}
+    for res in session.irods_session.query(DataObject.name, DataObject.replica_status)\
+                                    .filter(Collection.name == collection):
+        states.setdefault(res[DataObject.name], (None, set()))[1].add(
+            REPLICA_STATES.get(res[DataObject.replica_status], res[DataObject.replica_status]))
+    for res in session.irods_session.query(DataObject.name, DataObjectMeta.value)\
+                                    .filter(Collection.name == collection)\
+                                    .filter(DataObjectMeta.name == 'archive_status'):
+        if res[DataObject.name] in states:
+            states[res[DataObject.name]] = (res[DataObjectMeta.value], states[res[DataObject.name]][1])
+    return states
+
+
+def get_collection_contents(session, collection: str):
+    """Get the names of the data objects and subcollections in a collection,
+    with one catalog query for each instead of an existence check per path
+    Args:
+        session (ibridges.Session): irods session
+        collection (str): absolute path of the collection
+    Returns:
+        tuple: set of data object names, set of subcollection names. Empty if the collection does not exist
+    """
+    dataobjects = {res[DataObject.name] for res in
+                   session.irods_session.query(DataObject.name).filter(Collection.name == collection)}
+    subcollections = {res[Collection.name].rsplit('/', 1)[-1] for res in
+                      session.irods_session.query(Collection.name).filter(Collection.parent_name == collection)}
+    return dataobjects, subcollections
+
+
+def get_collection_listing(session, collection: str):
+    """Get the size and replica states of all data objects below a collection and the paths of its subcollections,
+    with one catalog query for the collection and one for everything below it.
+    In the like pattern _ and % of the collection name are wildcards too, e.g. a_b also matches aXb, so the
+    results are filtered on the exact collection afterwards
+    Args:
+        session (ibridges.Session): irods session
+        collection (str): absolute path of the collection
+    Returns:
+        tuple: dict of relative path: (size, set of replica states), set of relative paths of the subcollections.
+               Empty if the collection does not exist
+    """
+    files = {}
+    for criterion in [Collection.name == collection, Like(Collection.name, f"{collection}/%")]:
+        for res in session.irods_session.query(Collection.name, DataObject.name, DataObject.size,
+                                               DataObject.replica_status).filter(criterion):
+            if res[Collection.name] != collection and not res[Collection.name].startswith(f"{collection}/"):
+                continue
+            rel_path = posixpath.relpath(posixpath.join(res[Collection.name], res[DataObject.name]), collection)
+            size, states = files.setdefault(rel_path, (int(res[DataObject.size]), set()))
+            states.add(REPLICA_STATES.get(res[DataObject.replica_status], res[DataObject.replica_status]))
+    subcollections = {posixpath.relpath(res[Collection.name], collection) for res in
+                      session.irods_session.query(Collection.name).filter(Like(Collection.name, f"{collection}/%"))
+                      if res[Collection.name].startswith(f"{collection}/")}
+    return files, subcollections
+
+
+def find_failed_uploads(listing: dict, expected: list) -> list:
+    """Compare a collection listing with the files that should be in it
+    Args:
+        listing (dict): relative path: (size, set of replica states), see get_collection_listing
+        expected (list): (relative path, size) of the files, size None when it is not known beforehand
+    Returns:
+        list: relative paths of the files that are missing, have another size or replicas that are not good
+    """
+    failed = []
+    for rel_path, size in expected:
+        found = listing.get(rel_path)
+        if found is None or found[1] != {'good'} or (size is not None and found[0] != size):
+            failed.append(rel_path)
+    return failed
+
+
+def get_avus(row) -> list:
+    """Convert the metadata columns of a row to attribute, value pairs
+    Args:
+        row (dict): metadata to convert
+    Returns:
+        list: (attribute, value) tuples
+    """
+    avus = []
     for col in row.keys():
         # Skip upload status columns
         if col[0] == '_':
@@ -36,24 +213,44 @@ def add_metadata(session, row):
         else:
             tagname = f"NPEC_{col}"
         # ---------------------------------------------
-        # print(f"{tagname}: {row[col]}")
-        if not obj_meta.__contains__(tagname):
-            if str(row[col]) == 'nan':
-                obj_meta.add(tagname.rstrip(), '-')
-            # NPEC ---------------------------------------
-            elif row[col] == 'Traitseeker_UAVS':
-                obj_meta.add(tagname.rstrip(), 'Traitseeker')
-                obj_meta.add(tagname.rstrip(), 'UAV')
-            elif row[col] == 'UAVS':
-                obj_meta.add(tagname.rstrip(), 'UAV')
-            elif col == 'Crop':
-                for val in row[col].split(','):
-                    obj_meta.add(tagname.rstrip(), val.strip().lower())
-            elif col == 'NPEC_potcount' or col == 'potcount':
-                obj_meta.add(tagname.rstrip(), str(int(row[col])).rstrip())
-            # ---------------------------------------------
-            else:
-                obj_meta.add(tagname.rstrip(), str(row[col]).rstrip())
+        if str(row[col]) == 'nan':
+            avus.append((tagname.rstrip(), '-'))
+        # NPEC ---------------------------------------
+        elif row[col] == 'Traitseeker_UAVS':
+            avus.append((tagname.rstrip(), 'Traitseeker'))
+            avus.append((tagname.rstrip(), 'UAV'))
+        elif row[col] == 'UAVS':
+            avus.append((tagname.rstrip(), 'UAV'))
+        elif col == 'Crop':
+            for val in row[col].split(','):
+                avus.append((tagname.rstrip(), val.strip().lower()))
+        elif col == 'NPEC_potcount' or col == 'potcount':
+            avus.append((tagname.rstrip(), str(int(row[col])).rstrip()))
+        # ---------------------------------------------
+        else:
+            avus.append((tagname.rstrip(), str(row[col]).rstrip()))
+    return avus
+
+
+def add_metadata(session, row):
+    """Add metdata to an irods dataobject, all attributes are added in one atomic operation
+    Attributes that are already present are skipped
+    Args:
+        session (ibridges.Session): irods session
+        row (dict): metadata to add
+    Returns:
+        bool: True if successful
+    """
+    i_path = IrodsPath(session, row['_iPath'])
+    if not i_path.dataobject_exists():
+        logging.error(f"Adding metadata, data object {i_path} not found")
+        return False
+    do = get_dataobject(session, i_path)
+    existing = {avu.name for avu in do.metadata.items()}
+    operations = [AVUOperation(operation='add', avu=iRODSMeta(name, value))
+                  for name, value in get_avus(row) if name not in existing]
+    if operations:
+        do.metadata.apply_atomic_operations(*operations)
     logging.info(f"Metadata added to {i_path}")
     return True
 
@@ -82,30 +279,145 @@ def send_to_tape(session, row):
             return False
 
 
-def check_status(session, row):
-    """check the archiving status of a dataobject
+def upload_with_checksum(session, local_path: Path, irods_path, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                         progress=None) -> str:
+    """Upload a file in chunks through a data object stream, the SHA-256 and MD5 are computed from the same chunks
+    so the local file is read only once. A single stream instead of the parallel transfer of put, which
+    would need a second read of the file to hash it and can't be continued after an interruption, see
+    resumable_upload. The transfers run in parallel over the files, on the upload threads and iRODS workers.
     Args:
         session (ibridges.Session): irods session
-        row (dict): metadata of object
+        local_path (Path): file to upload
+        irods_path (IrodsPath): data object to create, an existing one is overwritten
+        chunk_size (int): bytes per read and write
+        progress (callable): optional, called with the number of bytes of every chunk that is uploaded
     Returns:
-        bool: True if archived, false if not
+        str: checksum of the file, sha2:<base64 digest> <hex MD5>
     """
-    i_path = IrodsPath(session, row['_iPath'])
-    do = get_dataobject(session, i_path)
-    status = max(repl[4] for repl in obj_replicas(do))
-    if status != 'good':
-        # status can be: stale, good, intermediate, write-locked
-        logging.info(f"Bad status detected after upload for {i_path}")
+    digest = Digest()
+    with open(local_path, 'rb') as file, session.irods_session.data_objects.open(str(irods_path), 'w') as obj:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            obj.write(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    return irods_checksum(digest)
+
+
+def resumable_upload(session, local_path: Path, irods_path, offset: int = 0, prefix_digest: str = None,
+                     checkpoint=None, checkpoint_size: int = UPLOAD_CHECKPOINT_SIZE,
+                     chunk_size: int = UPLOAD_CHUNK_SIZE, progress=None) -> str:
+    """Upload a big file in chunks, an interrupted upload continues where it was.
+    Every checkpoint_size bytes the data object stream is flushed and checkpoint(offset, digest) is called
+    with the hex SHA-256 of the file up to the offset, to store it in the progress state. The SHA-256 state
+    itself can not be stored, so to continue the local file is hashed up to the offset again and compared
+    with that digest. When it matches the data object is opened without truncating it and the upload
+    continues at the offset, otherwise it starts over.
+    Args:
+        session (ibridges.Session): irods session
+        local_path (Path): file to upload
+        irods_path (IrodsPath): data object to create or continue
+        offset (int): offset of the last checkpoint, 0 to start over
+        prefix_digest (str): hex SHA-256 of the file up to the offset
+        checkpoint (callable): optional, called with the offset and the hex SHA-256 of the file up to it
+        checkpoint_size (int): bytes between checkpoints
+        chunk_size (int): bytes per read and write
+        progress (callable): optional, called with the number of bytes of every chunk that is uploaded
+    Returns:
+        str: checksum of the file, sha2:<base64 digest> <hex MD5>, the MD5 is also computed over the part up to the
+            offset that is hashed again
+    """
+    digest = Digest()
+    with open(local_path, 'rb') as file:
+        obj = None
+        if offset:
+            while file.tell() < offset:
+                chunk = file.read(min(chunk_size, offset - file.tell()))
+                if not chunk:
+                    break
+                digest.update(chunk)
+            if file.tell() == offset and digest.hexdigest() == prefix_digest:
+                try:
+                    obj = session.irods_session.data_objects.open(str(irods_path), 'r+')
+                    obj.seek(offset)
+                    logging.info(f"Continuing the upload of {local_path} at {offset} bytes")
+                except Exception as e:
+                    logging.warning(f"Can not continue the upload of {local_path}, starting over: {e}")
+                    if obj is not None:
+                        obj.close()
+                        obj = None
+            else:
+                logging.warning(f"{local_path} changed since its upload was interrupted, starting over")
+        if obj is None:
+            offset = 0
+            digest = Digest()
+            file.seek(0)
+            obj = session.irods_session.data_objects.open(str(irods_path), 'w')
+        with obj:
+            last_checkpoint = offset
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                obj.write(chunk)
+                offset += len(chunk)
+                if progress is not None:
+                    progress(len(chunk))
+                if checkpoint is not None and offset - last_checkpoint >= checkpoint_size:
+                    obj.flush()
+                    checkpoint(offset, digest.hexdigest())
+                    last_checkpoint = offset
+    return irods_checksum(digest)
+
+
+def verify_checksum(session, irods_path, checksum: str) -> bool:
+    """Compare a checksum computed while writing with the checksum that iRODS computes and registers
+    for the data object, the data is read by the server not by the client.
+    iRODS uses the default hash scheme of the server, SHA256 or MD5, the checksum of the same scheme is compared.
+    Other schemes, and MD5 for a checksum without one, e.g. of a zip of an older version, can't be compared and fail.
+    Args:
+        session (ibridges.Session): irods session
+        irods_path (IrodsPath): data object
+        checksum (str): expected checksum, sha2:<base64 digest> <hex MD5>, see irods_checksum
+    Returns:
+        bool: True if the checksums match
+    """
+    irods_checksum = session.irods_session.data_objects.chksum(str(irods_path))
+    scheme = 'sha2' if irods_checksum.startswith('sha2:') else 'md5' if re.fullmatch('[0-9a-f]{32}', irods_checksum) \
+        else None
+    checksum = checksum_schemes(checksum).get(scheme)
+    if checksum is None:
+        logging.error(f"iRODS uses another checksum scheme for {irods_path}: {irods_checksum}, it can't be "
+                      f"compared, use the SHA256 or MD5 scheme on the server")
         return False
-    obj_meta = MetaData(do)
-    if obj_meta.__contains__('archive_status'):
-        metadata = obj_meta.to_dict()['metadata']
-        for key, val, unit in metadata:
-            if key == 'archive_status':
-                # logging.info(f"Archive rule status for {i_path}: {val}")
-                if val == 'completed_and_hot_deleted':
-                    return True
-    return False
+    if irods_checksum != checksum:
+        logging.error(f"Checksum mismatch for {irods_path}: {irods_checksum} in iRODS, {checksum} local")
+        return False
+    logging.info(f"Checksum verified for {irods_path}")
+    return True
+
+
+class IrodsZipWriter(SplitWriter):
+    """Zip stream that writes its parts straight into iRODS data objects"""
+    def __init__(self, session: Session, zip_ipath: IrodsPath, part_size: int = FIVE_TB_FILE_LIMIT):
+        self.session = session
+        super().__init__(zip_ipath, part_size)
+
+    def _with_suffix(self, path, suffix: str):
+        return path.parent.joinpath(path.name.rsplit('.', 1)[0] + suffix)
+
+    def _open_part(self, path):
+        return self.session.irods_session.data_objects.open(str(path), 'w')
+
+    def _rename_part(self, source, target):
+        # Leftovers of an earlier, interrupted, stream are overwritten
+        if target.dataobject_exists():
+            self.session.irods_session.data_objects.unlink(str(target), force=True)
+        self.session.irods_session.data_objects.move(str(source), str(target))
 
 
 class I_WORKER(multiprocessing.Process):
@@ -114,65 +426,448 @@ class I_WORKER(multiprocessing.Process):
                  password: str,
                  stop_worker: multiprocessing.Event,
                  files_to_upload_queue: multiprocessing.Queue,
-                 uploaded_queue: multiprocessing.Queue,
-                 id: int):
+                 events_queue: multiprocessing.Queue,
+                 id: int,
+                 stream_zip: bool = False,
+                 zip_threads: int = 1,
+                 session_max_age: int = 3600,
+                 upload_threads: int = 4,
+                 bundle_file_limit: int = 0,
+                 bundle_size: int = 4 * 2**30,
+                 checkpoint_size: int = UPLOAD_CHECKPOINT_SIZE,
+                 retire_queue: multiprocessing.Queue = None,
+                 progress: ProgressCounter = None):
         super().__init__()
         self.ienv = ienv
         self.password = password
         self.stop_worker = stop_worker
         self.files_to_upload_queue = files_to_upload_queue
-        self.uploaded_queue = uploaded_queue
+        self.events_queue = events_queue
         self.id = id
+        self.stream_zip = stream_zip
+        self.zip_threads = zip_threads
+        self.session_max_age = session_max_age
+        self.upload_threads = upload_threads
+        self.bundle_file_limit = bundle_file_limit
+        self.bundle_size = bundle_size
+        self.checkpoint_size = checkpoint_size
+        self.retire_queue = retire_queue
+        # Bytes uploaded, for the controller of the number of iRODS workers
+        self.progress = progress
+
+    def count_bytes(self, num_bytes: int):
+        """Add uploaded bytes to the progress of the stage, also called by the upload threads"""
+        if self.progress is not None:
+            self.progress.add(num_bytes)
 
-    def uploader(self, local_path, irods_path):
+    def stream_uploader(self, local_path: Path, irods_path: IrodsPath, scan: ScanResult = None) -> tuple:
+        """Zip a folder straight into iRODS, without a temporary zip file on disk.
+        Archives above 5TB are split in parts name.zip.001, name.zip.002, ..., see SplitWriter.
+        The central directory is read back and checked against the written entries.
+        Args:
+            local_path: Path
+                folder to zip
+            irods_path: IrodsPath
+                path of the zip in iRODS
+            scan: ScanResult
+                optional, file list of the folder from the size scan
+        Returns:
+            tuple: iRODS paths of the parts in order, the first one gets the metadata, and their checksums
+        """
+        start_time = datetime.now()
+        logging.info(f"Streaming zip of {local_path} to {irods_path}")
+        writer = IrodsZipWriter(self.session, irods_path)
+        try:
+            entries = zip_folder(local_path, writer, scan, self.zip_threads, self.count_bytes)
+            parts = writer.finish()
+        finally:
+            writer.close()
+        write_crc_report(entries, Path(__file__).parent.joinpath('logs', f"{local_path.name}.sfv"))
+        logging.info(f"Uploader {self.id} streamed {local_path} in {len(parts)} part(s) "
+                     f"in {datetime.now() - start_time}, {summarize_methods(entries)}")
+        handles = [self.session.irods_session.data_objects.open(str(part), 'r') for part in parts]
+        with ConcatReader(handles) as reader:
+            if not verify_archive(reader, entries):
+                raise IOError(f"Streamed zip {irods_path} is not valid")
+        return parts, writer.checksums
+
+    def streamed_parts(self, irods_path: IrodsPath) -> list:
+        """Find a zip that an earlier run streamed completely, the .zip or the parts .zip.001, .zip.002, ... of a split
+        stream. The last part of a split stream keeps a temporary name until the archive is finished, so the parts
+        are only complete when the central directory can be read from them.
+        Args:
+            irods_path: IrodsPath
+                path of the zip in iRODS
+        Returns:
+            list: iRODS paths of the parts in order, empty when there is no complete zip
+        """
+        if irods_path.dataobject_exists():
+            return [irods_path]
+        dataobjects, _ = get_collection_contents(self.session, str(irods_path.parent))
+        parts = []
+        while f"{irods_path.name}.{len(parts) + 1:03d}" in dataobjects:
+            parts.append(irods_path.parent.joinpath(f"{irods_path.name}.{len(parts) + 1:03d}"))
+        if not parts:
+            return []
+        handles = [self.session.irods_session.data_objects.open(str(part), 'r') for part in parts]
+        with ConcatReader(handles) as reader:
+            if not is_complete_archive(reader):
+                logging.info(f"{parts[0]} is a part of an interrupted stream, streaming {irods_path} again")
+                return []
+        logging.info(f"{irods_path} was streamed already, in {len(parts)} parts")
+        return parts
+
+    def stream_upload(self, local_path: Path, irods_path: IrodsPath, scan: ScanResult = None) -> tuple:
+        """Stream a folder as a zip into iRODS, unless an earlier run streamed it completely, and check the parts
+        Args:
+            local_path: Path
+                folder to zip
+            irods_path: IrodsPath
+                path of the zip in iRODS
+            scan: ScanResult
+                optional, file list of the folder from the size scan
+        Returns:
+            tuple: iRODS paths of the parts in order, the first one gets the metadata, and their checksums,
+                None for the parts of an earlier run
+        """
         if not irods_path.parent.collection_exists():
             create_collection(self.session, irods_path.parent)
             logging.info(f"creating irods collection: {irods_path.parent}")
-        # check if data object exists
-        if not irods_path.dataobject_exists():
+        parts = self.streamed_parts(irods_path)
+        checksums = [None] * len(parts)
+        if not parts:
+            parts, checksums = self.stream_uploader(local_path, irods_path, scan)
+        for part, part_checksum in zip(parts, checksums):
+            self.check_file_status(part, part_checksum)
+        return parts, checksums
+
+    def upload_file(self, local_path: Path, irods_path: str, size: int) -> tuple:
+        """Upload a single file of a folder, runs in the upload threads with a session of the pool.
+        The checksum is compared with the checksum iRODS computes, a mismatch fails the upload
+        Returns:
+            tuple: size and checksum of the file
+        """
+        with self.session_pool.session() as session:
+            checksum = upload_with_checksum(session, local_path, irods_path, progress=self.count_bytes)
+            if not verify_checksum(session, irods_path, checksum):
+                raise IOError(f"Checksum of {irods_path} does not match {local_path}")
+            return size, checksum
+
+    def upload_bundle(self, local_path: Path, irods_path: str, files: list) -> tuple:
+        """Zip a bundle of small files of a folder straight into iRODS, runs in the upload threads
+        Args:
+            local_path: Path
+                folder of the files
+            irods_path: str
+                path of the bundle in iRODS
+            files: list
+                (relative path, size) of the files in the bundle
+        Returns:
+            tuple: size and checksum of the bundle
+        """
+        with self.session_pool.session() as session:
+            writer = IrodsZipWriter(session, IrodsPath(session, irods_path))
+            try:
+                zip_folder(local_path, writer, ScanResult(sum(size for _, size in files), len(files), files, []),
+                           self.zip_threads, self.count_bytes)
+                writer.finish()
+            finally:
+                writer.close()
+            if not verify_checksum(session, irods_path, writer.checksums[-1]):
+                raise IOError(f"Checksum of bundle {irods_path} does not match")
+            return writer.position, writer.checksums[-1]
+
+    def upload_files(self, local_path: Path, collection: IrodsPath, to_upload: list, to_bundle: list,
+                     row_id: int = None) -> dict:
+        """Upload files and bundles of a folder in parallel, on upload_threads threads.
+        The uploaded files are reported to the coordinator in batches, failed uploads are logged and left out,
+        also files and bundles whose checksum does not match the checksum iRODS computes.
+        Args:
+            local_path: Path
+                folder of the files
+            collection: IrodsPath
+                collection of the folder in iRODS
+            to_upload: list
+                (relative path, size) of the files to upload
+            to_bundle: list
+                (relative path, files) of the bundles to zip into iRODS
+            row_id: int
+                row id of the task, sent along with the uploaded files
+        Returns:
+            dict: relative path: checksum of the files and bundles that were uploaded
+        """
+        batch = []
+        checksums = {}
+        with ThreadPoolExecutor(self.upload_threads) as executor:
+            # Bundles first, they take longest
+            futures = {executor.submit(self.upload_bundle, local_path, f"{collection}/{rel_path}", bundle): rel_path
+                       for rel_path, bundle in to_bundle}
+            futures.update({executor.submit(self.upload_file, local_path.joinpath(rel_path),
+                                            f"{collection}/{rel_path}", size): rel_path
+                            for rel_path, size in to_upload})
+            for future in as_completed(futures):
+                rel_path = futures[future]
+                try:
+                    size, checksums[rel_path] = future.result()
+                except Exception as e:
+                    logging.warning(f"Error uploading {local_path.joinpath(rel_path)}: {e}")
+                    continue
+                batch.append((rel_path, size, checksums[rel_path]))
+                if len(batch) == 1000:
+                    self.events_queue.put((FILES_UPLOADED, self.id, {'_row': row_id, 'files': batch}))
+                    batch = []
+        if batch:
+            self.events_queue.put((FILES_UPLOADED, self.id, {'_row': row_id, 'files': batch}))
+        return checksums
+
+    def collection_uploader(self, local_path: Path, irods_path: IrodsPath, scan: ScanResult = None,
+                            row_id: int = None):
+        """Upload the files of a folder in parallel, on upload_threads threads.
+        Files that are already in iRODS with the same size and good replicas are skipped, so an interrupted
+        upload continues where it stopped. With bundle_file_limit set, the files below it are zipped in bundles
+        of about bundle_size in the subcollection _bundles, next to a manifest.csv with the bundle of every file.
+        Every file and bundle is compared with the checksum iRODS computes right after its upload. Afterwards the
+        collection is verified with one catalog query, files that are missing, have another size or checksum
+        or replicas that are not good are uploaded again, up to UPLOAD_RETRIES times.
+        Args:
+            local_path: Path
+                folder to upload
+            irods_path: IrodsPath
+                collection to upload the folder to
+            scan: ScanResult
+                optional, file list of the folder from the size scan
+            row_id: int
+                row id of the task, sent along with the uploaded files
+        """
+        if scan is None:
+            scan = scan_folder(str(local_path))
+        files, bundles = scan.files, []
+        if self.bundle_file_limit > 0:
+            files, bundles = plan_bundles(scan.files, self.bundle_file_limit, self.bundle_size)
+        collection = irods_path.joinpath(local_path.name)
+        existing, subcollections = get_collection_listing(self.session, str(collection))
+        for rel_path in [''] + scan.dirs + ([BUNDLE_COLLECTION] if bundles else []):
+            if rel_path not in subcollections:
+                create_collection(self.session, collection.joinpath(rel_path) if rel_path else collection)
+        # Bundles are written as .zip.part, an existing bundle with good replicas is complete
+        bundle_paths = [f"{BUNDLE_COLLECTION}/{bundle_name(i)}" for i in range(len(bundles))]
+        expected = files + [(rel_path, None) for rel_path in bundle_paths]
+        failed = set(find_failed_uploads(existing, expected))
+        for attempt in range(UPLOAD_RETRIES + 1):
+            to_upload = [(rel_path, size) for rel_path, size in files if rel_path in failed]
+            to_bundle = [(rel_path, bundle) for rel_path, bundle in zip(bundle_paths, bundles) if rel_path in failed]
+            start_time = datetime.now()
+            logging.info(f"Uploading {len(to_upload)}/{len(files)} files and {len(to_bundle)}/{len(bundles)} "
+                         f"bundles of {local_path} to {collection}")
+            checksums = self.upload_files(local_path, collection, to_upload, to_bundle, row_id)
+            logging.info(f"Uploader {self.id} uploaded {len(to_upload)} files and {len(to_bundle)} bundles of "
+                         f"{local_path} in {datetime.now() - start_time}")
+
+            # Check all files and bundles of the folder at once, their checksums were compared by the upload threads
+            existing, _ = get_collection_listing(self.session, str(collection))
+            failed = set(find_failed_uploads(existing, expected))
+            failed.update(rel_path for rel_path, _ in to_upload + to_bundle if rel_path not in checksums)
+            if not failed:
+                break
+            if attempt < UPLOAD_RETRIES:
+                logging.warning(f"{len(failed)} files of {local_path} failed to upload or are not good in iRODS, "
+                                f"retrying them")
+        else:
+            raise IOError(f"{len(failed)} files of {local_path} failed to upload after {UPLOAD_RETRIES} retries, "
+                          f"e.g. {sorted(failed)[0]}")
+        if bundles:
+            manifest_path = f"{collection}/{BUNDLE_COLLECTION}/{MANIFEST_NAME}"
+            with self.session.irods_session.data_objects.open(manifest_path, 'w') as manifest:
+                manifest.write(create_manifest(bundles))
+
+    def uploader(self, local_path, irods_path, scan: ScanResult = None, checksum: str = None,
+                 row_id: int = None, resume: tuple = None) -> str:
+        """Upload a file, zip or folder and check the result
+        Args:
+            local_path: Path
+                file, zip or folder to upload
+            irods_path: IrodsPath
+                target in iRODS
+            scan: ScanResult
+                optional, file list of the folder from the size scan
+            checksum: str
+                optional, checksum of the local file computed earlier, e.g. while zipping. Files are hashed
+                while they are uploaded, the checksum is compared with the checksum iRODS computes
+            row_id: int
+                optional, row id of the task, used to report the progress of folders and big files
+            resume: tuple
+                optional, offset and hex SHA-256 of the last checkpoint of an interrupted upload of a big file.
+                Without a checkpoint an existing data object is overwritten, unless is_uploaded accepts it
+        Returns:
+            str: checksum of the data object, None if it is unknown
+        """
+        if self.stream_zip and local_path.is_dir():
+            return self.stream_upload(local_path, irods_path, scan)[1][0]
+        if not irods_path.parent.collection_exists():
+            create_collection(self.session, irods_path.parent)
+            logging.info(f"creating irods collection: {irods_path.parent}")
+        if local_path.is_dir():
+            self.collection_uploader(local_path, irods_path, scan, row_id)
+            return None
+
+        # An interrupted upload of a big file is continued, an object of an earlier run is only kept when it is
+        # complete, otherwise it is overwritten
+        if resume is not None or not self.is_uploaded(local_path, irods_path, checksum):
             start_time = datetime.now()
             logging.info(f"Uploading {local_path} to {irods_path}")
-            upload(self.session, local_path, irods_path, overwrite=True)
+            if local_path.stat().st_size > self.checkpoint_size:
+                upload_checksum = self.checkpointed_upload(local_path, irods_path, row_id, resume)
+            else:
+                upload_checksum = upload_with_checksum(self.session, local_path, irods_path,
+                                                       progress=self.count_bytes)
+            # A zip has a checksum from zipping, it should not change on disk before it is uploaded
+            if checksum is not None and checksum_schemes(upload_checksum)['sha2'] != checksum_schemes(checksum)['sha2']:
+                raise IOError(f"{local_path} changed after zipping: {upload_checksum}, {checksum} when zipped")
+            checksum = upload_checksum
             logging.info(f"Uploader {self.id} uploaded {local_path} in {datetime.now() - start_time}")
 
-        # Check if the file or files in folder are uploaded succesfully
-        if irods_path.dataobject_exists():
-            self.check_file_status(irods_path)
-        elif irods_path.collection_exists():
-            files = [file.relative_to(local_path.parent) for file in local_path.rglob('*') if file.is_file()]
-            for file in files:
-                self.check_file_status(irods_path.joinpath(file))
+        # Check if the file is uploaded succesfully
+        self.check_file_status(irods_path, checksum)
+        return checksum
+
+    def is_uploaded(self, local_path: Path, irods_path: IrodsPath, checksum: str = None) -> bool:
+        """Check if a data object of an earlier run is the complete upload of a local file.
+        A failed or interrupted upload can leave a partial object behind, so the object is only accepted when a
+        checksum of the local file is known, e.g. from zipping, and the size and checksum match.
+        Args:
+            local_path: Path
+                file to upload
+            irods_path: IrodsPath
+                data object in iRODS
+            checksum: str
+                optional, checksum of the local file, without it an existing object is not accepted
+        Returns:
+            bool: True if the upload can be skipped
+        """
+        if not irods_path.dataobject_exists():
+            return False
+        if checksum is None:
+            logging.info(f"{irods_path} exists without a checksum to compare it with, uploading it again")
+            return False
+        size = get_dataobject(self.session, irods_path).size
+        if size != local_path.stat().st_size:
+            logging.info(f"{irods_path} has {size} of {local_path.stat().st_size} bytes, uploading it again")
+            return False
+        if not verify_checksum(self.session, irods_path, checksum):
+            logging.info(f"{irods_path} does not match {local_path}, uploading it again")
+            return False
+        logging.info(f"{irods_path} was uploaded already")
+        return True
+
+    def checkpointed_upload(self, local_path: Path, irods_path: IrodsPath, row_id: int = None,
+                            resume: tuple = None) -> str:
+        """Upload a big file with checkpoints in the progress state, see resumable_upload.
+        A continued upload whose data object does not match the local file afterwards is done again.
+        Args:
+            local_path: Path
+                file to upload
+            irods_path: IrodsPath
+                data object in iRODS
+            row_id: int
+                row id of the task, the checkpoints are stored with it
+            resume: tuple
+                optional, offset and hex SHA-256 of the last checkpoint
+        Returns:
+            str: checksum of the file
+        """
+        def checkpoint(offset: int, digest: str):
+            self.events_queue.put((UPLOAD_PROGRESS, self.id, {'_row': row_id, '_uploadOffset': offset,
+                                                              '_uploadDigest': digest}))
+
+        offset, prefix_digest = resume if resume is not None else (0, None)
+        checksum = resumable_upload(self.session, local_path, irods_path, offset, prefix_digest, checkpoint,
+                                    self.checkpoint_size, progress=self.count_bytes)
+        if offset and not verify_checksum(self.session, irods_path, checksum):
+            logging.warning(f"Continued upload of {local_path} does not match the local file, starting over")
+            checksum = resumable_upload(self.session, local_path, irods_path, 0, None, checkpoint,
+                                        self.checkpoint_size, progress=self.count_bytes)
+        return checksum
 
     def run(self):
-        self.session = Session(irods_env=self.ienv, password=self.password)
+        # The coordinator handles interrupts and stops the workers with stop_worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Sessions of the worker and its upload threads, replaced when they get too old or broke down,
+        # instead of a new session per big file
+        self.session_pool = SessionPool(self.ienv, self.password, self.upload_threads + 1, self.session_max_age)
         while not self.stop_worker.is_set():
+            if retire_requested(self.retire_queue):
+                logging.info("Retiring I_WORKER %d", self.id)
+                self.session_pool.close()
+                self.events_queue.put((IWORKER_STOPPED, self.id, {'retired': True}))
+                break
             local_path = ""
             row_dict = self.files_to_upload_queue.get()
             if 'NONE' in row_dict.keys() or self.stop_worker.is_set():
                 # Sentinel value to indicate the end of the queue
                 logging.info("Stopping I_WORKER %d", self.id)
-                self.uploaded_queue.put(self.id)
+                self.session_pool.close()
+                self.events_queue.put((IWORKER_STOPPED, self.id, None))
                 break
-            elif (row_dict['_size'] > 10000000) or (row_dict['_status'] == 'Zipped FF'):
-                # Create a new iRODS session for big files to avoid hitting the timeouts.
-                self.session.close()
-                self.session = Session(irods_env=self.ienv, password=self.password)
-                logging.info(f"I worker {self.id} refreshed its irods session")
             # Only non-empty values will pass the if below
+            scan = row_dict.pop('_scan', None)
             if not pd.isna(row_dict['_zipPath']) and row_dict['_zipPath'] != '':
                 local_path = Path(row_dict['_zipPath'])
+                scan = None
             else:
                 local_path = Path(row_dict['_Path'])
-            irods_path = IrodsPath(self.session, row_dict['_iPath'])
+            checksum = row_dict.get('_checksum')
+            if pd.isna(checksum) or checksum == '':
+                checksum = None
+            # Checkpoint of an interrupted upload of a big file
+            resume = None
+            if not pd.isna(row_dict.get('_uploadOffset')) and not pd.isna(row_dict.get('_uploadDigest')):
+                resume = (int(row_dict['_uploadOffset']), row_dict['_uploadDigest'])
+            # Bytes and seconds of the upload and the metadata, for the metrics of the coordinator
+            timings = {'_uploadBytes': scan.size if scan is not None else 0, '_uploadSeconds': 0.0,
+                       '_metadataSeconds': 0.0}
+            start_time = time()
             try:
-                self.uploader(local_path, irods_path)
-                self.uploaded_queue.put(str(irods_path))
+                with self.session_pool.session() as self.session:
+                    irods_path = IrodsPath(self.session, row_dict['_iPath'])
+                    if local_path.is_file():
+                        timings['_uploadBytes'] = local_path.stat().st_size
+                    part_checksums = {}
+                    if self.stream_zip and local_path.is_dir():
+                        # A split stream has no .zip, the metadata goes to the first part like with zips on disk,
+                        # the coordinator adds the other parts to the tasks
+                        parts, checksums = self.stream_upload(local_path, irods_path, scan)
+                        checksum = checksums[0]
+                        row_dict['_iPath'] = str(parts[0])
+                        part_checksums = {str(part): part_checksum
+                                          for part, part_checksum in zip(parts[1:], checksums[1:])}
+                    else:
+                        checksum = self.uploader(local_path, irods_path, scan, checksum, row_dict.get('_row'),
+                                                 resume)
+                    timings['_uploadSeconds'] = time() - start_time
+                    # Add the metadata right away, so it overlaps with the uploads of the other workers
+                    # A failure leaves the upload 'Uploaded', the coordinator adds the metadata again afterwards
+                    status = 'Uploaded'
+                    try:
+                        if add_metadata(self.session, row_dict):
+                            status = 'Metadata added'
+                    except Exception as e:
+                        logging.error(f"Error adding metadata to {row_dict['_iPath']}: {e}")
+                    timings['_metadataSeconds'] = time() - start_time - timings['_uploadSeconds']
+                self.events_queue.put((UPLOADED, self.id, {'_row': row_dict.get('_row'), '_iPath': row_dict['_iPath'],
+                                                           '_status': status, '_checksum': checksum,
+                                                           '_partChecksums': part_checksums, **timings}))
             except Exception as e:
                 logging.error(f"Error uploading file {local_path}: {e}")
+                timings['_uploadSeconds'] = time() - start_time
+                self.events_queue.put((UPLOADED, self.id, {'_row': row_dict.get('_row'), '_iPath': row_dict['_iPath'],
+                                                           '_status': 'Upload failed', '_checksum': None, **timings}))
 
-    def check_file_status(self, irods_path):
+    def check_file_status(self, irods_path, checksum: str = None):
+        """Check the replicas and the checksum of an uploaded data object, raises an IOError when they are not
+        right so the upload is reported as failed"""
         logging.info(f"Checking status of {irods_path}")
         status = max(repl[4] for repl in obj_replicas(get_dataobject(self.session, irods_path)))
         if status != 'good':
-            logging.info(f"Bad status detected after upload for {irods_path}")
-            exit(1)
+            raise IOError(f"Bad status detected after upload for {irods_path}: {status}")
+        if checksum is not None and not verify_checksum(self.session, irods_path, checksum):
+            raise IOError(f"Checksum of {irods_path} does not match")
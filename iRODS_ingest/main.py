@@ -3,44 +3,67 @@ from pathlib import Path
 import argparse
 import logging
 import multiprocessing
+import os
 import pandas as pd
 import queue
+from time import time
 
 import utils as utils
-from __init__ import FIVE_TB_FILE_LIMIT
+import scanner as scanner
+from __init__ import FIVE_TB_FILE_LIMIT, ZIPPED, UPLOADED, FILES_UPLOADED, UPLOAD_PROGRESS, ZIPPER_STOPPED, \
+    IWORKER_STOPPED, PLANNED, PLANNER_STOPPED
 # iBridges instantiates a logger which causes the basic config setting to be ignored
 utils.setup_logger()
 import ioperations as ioperations
 from smb import SMB
 from helpers import create_task_df, check_paths
+from excel import load_metadata_excel
 from zipper import ZipperProcess
-from ibridges import Session
+from planner import Planner
+from scheduler import DiskSpaceScheduler, JOB_ORDERS, estimate_zip_size, order_jobs
+from state import StateStore, TaskTable
+from tape import TapeScheduler
+from metrics import Metrics
+from controller import ConcurrencyController, ProgressCounter
 
 
-def queue_multipart_zips(to_upload_queue, upload_df, row_dict):
-    """Queue multipart zips and add them to the upload_df for status monitoring (parts don't get any metadata)"""
+def task_size(row: dict) -> int:
+    """Size of a task in bytes, 0 when it is not known"""
+    return 0 if pd.isna(row.get('_size')) else int(row['_size'])
+
+
+def queue_multipart_zips(to_upload_queue, tasks, row_dict):
+    """Queue multipart zips and add them to the tasks for status monitoring (parts don't get any metadata)"""
     parts = utils.check_for_multipart_zip(row_dict['_zipPath'])
+    # Checksums of the parts computed while zipping, not known for winrar zips
+    part_checksums = row_dict.pop('_partChecksums', {})
 
     # Single zip
     if len(parts) == 1:
         to_upload_queue.put(row_dict)
-        return upload_df
+        return
 
-    # Multipart zip
+    # Multipart zip, the metadata goes to the .zip of winrar or else to the first part, name.zip.001
     row_dict['_status'] = 'Zipped FF'
-    part_dicts = []
+    ipath = row_dict['_iPath']
+    if row_dict['_zipPath'] not in map(str, parts):
+        row_dict['_zipPath'] = str(parts[0])
+        row_dict['_iPath'] = ipath + parts[0].suffix
+        tasks.update(row_dict['_row'], {'_zipPath': row_dict['_zipPath'], '_iPath': row_dict['_iPath']},
+                     commit=False)
     for part in parts:
-        # Add part to status dataframe
-        if str(part) != row_dict['_zipPath']:
-            part_dict = row_dict.copy()
-            part_dict['_zipPath'] = str(part)
-            part_dict['_iPath'] = row_dict['_iPath'] + f".z{part.suffix[-2:]}"
-            part_dict['_size'] = 0
-            part_dicts.append(part_dict)
-        to_upload_queue.put(part_dict)
-    part_df = pd.DataFrame(part_dicts)
-    upload_df = pd.concat([upload_df, part_df], ignore_index=True)
-    return upload_df
+        if str(part) == row_dict['_zipPath']:
+            to_upload_queue.put(row_dict)
+            continue
+        # Add part to the tasks
+        part_dict = {key: value for key, value in row_dict.items() if key != '_row'}
+        part_dict['_zipPath'] = str(part)
+        part_dict['_iPath'] = ipath + part.suffix
+        part_dict['_size'] = 0
+        part_dict['_checksum'] = part_checksums.get(str(part))
+        part_row = tasks.append(part_dict, commit=False)
+        to_upload_queue.put(tasks.job(part_row))
+    tasks.state.commit()
 
 
 if __name__ == "__main__":
@@ -49,6 +72,8 @@ if __name__ == "__main__":
     parser.add_argument('--config', type=str, required=False, help='Path to the config file')
     parser.add_argument('-t', '--totape', dest='totape', default=False, required=False,
                         action="store_true", help='Add this flag to send files to tape')
+    parser.add_argument('-w', '--watch', dest='watch', default=False, required=False,
+                        action="store_true", help='Keep checking the tape status until everything is archived')
     args = parser.parse_args()
 
     # Check and load the config
@@ -60,12 +85,32 @@ if __name__ == "__main__":
         logging.error('Missing config file, exiting')
         exit(1)
     config = utils.load_json(config_file)
+    # Optional: zip folders straight into iRODS instead of via LOCAL_ZIP_TEMP
+    stream_zip = config['ZIP_FOLDERS'] and config.get('ZIP_STREAM', False)
+    # Compression threads per zipper, by default the cpus are divided over the zippers
+    num_zippers = config['NUM_IWORKERS'] if stream_zip else config['NUM_ZIPPERS']
+    zip_threads = config.get('ZIP_THREADS', max(1, (os.cpu_count() or 1) // max(1, num_zippers)))
+    # Order in which the zippers and the uploaders get their jobs
+    job_order = config.get('JOB_ORDER', 'longest_zip_first')
+    if job_order not in JOB_ORDERS:
+        logging.error(f"Unknown JOB_ORDER {job_order}, use one of {', '.join(JOB_ORDERS)}")
+        exit(1)
 
-    # Prep progress CSV path
+    # Prep progress CSV path, the state itself is stored in a SQLite file next to it
     if 'PROGRESS_FILE' in config.keys() and config['PROGRESS_FILE'] and Path(config['PROGRESS_FILE']).parent.is_dir():
         progress_file_path = Path(config['PROGRESS_FILE'])
     else:
         progress_file_path = Path(__file__).parent.joinpath('in_progress.csv')
+    state = StateStore(progress_file_path.with_suffix('.sqlite'))
+
+    # Throughput, queue depths and worker utilization, rewritten to logs/metrics.json and logs/metrics.prom
+    metrics = Metrics(Path(__file__).parent.joinpath('logs'), config.get('METRICS_INTERVAL', 30))
+
+    # Directory listings of earlier runs, stored next to the progress file. Opt-in, a file edited in place keeps
+    # its cached size
+    scan_cache = None
+    if config.get('SCAN_CACHE', False):
+        scan_cache = scanner.ScanCache(progress_file_path.with_name(progress_file_path.stem + '_scan_cache.sqlite'))
 
     # Retreive users password, used to mount the W if desired and login to iRODS
     password = getpass('Your iRODS password')
@@ -76,190 +121,430 @@ if __name__ == "__main__":
         smb.mount_share(password)
 
     # Check all the paths
-    source_path, zip_path, target_ipath, ienv = check_paths(config, password)
-    isession = Session(irods_env=ienv, password=password)
+    source_path, zip_path, target_ipath, ienv, session_pool = check_paths(config, password)
 
-    # Check if there is an 'in_progress.csv', if not create it
+    # Check if there is a progress state, if not create it
     # Only uploads the files with a 'v' in the '_to_upload' column
-    if Path(__file__).parent.joinpath('in_progress.csv').exists():
-        logging.info('Found in_progress.csv, continuing from there')
+    if state.has_tasks():
+        logging.info(f"Found {state.db_path}, continuing from there")
+        to_upload_df = state.load()
+    elif progress_file_path.exists():
+        # Progress csv of a run without the SQLite state
+        logging.info(f"Found {progress_file_path}, continuing from there")
         to_upload_df = pd.read_csv(progress_file_path)
+        state.save(to_upload_df)
     else:
-        metada_df = pd.read_excel(Path(source_path).joinpath(config['METADATA_EXCEL']),
-                                  skiprows=0, engine="openpyxl")
-        to_upload_df = metada_df.loc[metada_df['_to_upload'] == 'v'].copy()
+        # Streamed from the Excel, or from the cache next to the progress file when the Excel did not change
+        to_upload_df = load_metadata_excel(Path(source_path).joinpath(config['METADATA_EXCEL']),
+                                           progress_file_path.with_name(progress_file_path.stem + '_excel_cache'))
         if '_status' not in to_upload_df.columns:
             to_upload_df['_status'] = ""
         to_upload_df['_status'] = to_upload_df['_status'].astype(str)
-        to_upload_df = create_task_df(to_upload_df, source_path, target_ipath, zip_path, isession)
-        to_upload_df.to_csv(progress_file_path, index=False)
+        to_upload_df = create_task_df(to_upload_df, source_path, target_ipath, zip_path, stream_zip)
+        state.save(to_upload_df)
+        state.export_csv(progress_file_path)
+    tasks = TaskTable(to_upload_df, state)
 
     # Create the shared objects
     ff_to_zip_queue = multiprocessing.Queue()
-    zipped_files_queue = multiprocessing.Queue()
     to_upload_queue = multiprocessing.Queue()
-    uploaded_queue = multiprocessing.Queue()
+    # All workers report to the coordinator through one queue
+    events_queue = multiprocessing.Queue()
     stop_workers = multiprocessing.Event()
     available_diskspace = utils.parse_filesize(config['LOCAL_ZIP_SPACE'])
     zip_processes = {}
 
     # Loop over the files in the zipped folder, this space is already used...
-    for file in Path(config['LOCAL_ZIP_TEMP']).iterdir():
-        available_diskspace -= file.stat().st_size
+    if config['ZIP_FOLDERS'] and not stream_zip:
+        for file in Path(config['LOCAL_ZIP_TEMP']).iterdir():
+            available_diskspace -= file.stat().st_size
 
-    # Fill the queues with jobs
-    for ind, row in to_upload_df.iterrows():
+    # Check the jobs before the workers start, all missing paths are reported at once
+    # The sizes, empty folders and paths that exist in iRODS already are found by the planner while the workers run
+    to_plan = []
+    to_upload = []
+    missing = []
+    for ind, row in tasks.items():
         if row['_status'] == 'existing ipath' or row['_status'] == 'Empty folder':
             logging.info(f"Skipping existing iPath: {row['Foldername']}")
             continue
         # check if folder exists, else: exit program
         if not Path(row['_Path']).exists():
-            logging.error(f"Path does not exist {row['_Path']}, index: {ind}")
-            exit(1)
-        # Only compute the file/folder size if not already done
-        if pd.isna(row['_size']):
-            ff_size = utils.get_ffsize(row['_Path'])
-            row['_size'] = ff_size
-            to_upload_df.at[ind, '_size'] = ff_size
-            row['_size'] = ff_size
-        if row['_status'] == 'Empty folder':
-            logging.info(f"Skipping empty folder: {row['Foldername']}")
+            missing.append(f"Path does not exist {row['_Path']}, index: {ind}")
             continue
-        elif row['_status'] in ['Folder', 'Zipped FF'] and config['ZIP_FOLDERS']:
+        if row['_status'] == 'Zip failed':
+            # Zip again, the leftovers of the failed zip are deleted below
+            logging.info(f"Retrying the failed zip of {row['_Path']}")
+            tasks.update(ind, {'_status': 'Folder' if Path(row['_Path']).is_dir() else 'File'}, commit=False)
+        elif row['_status'] == 'Scan failed':
+            logging.info(f"Retrying the failed scan of {row['_Path']}")
+            tasks.update(ind, {'_status': 'Folder' if Path(row['_Path']).is_dir() else 'File'}, commit=False)
+        elif row['_status'] == 'Upload failed':
+            # Retry failed uploads, the zip of the earlier run is uploaded again when it is still there
+            zip_file = row['_zipPath']
+            zipped = not pd.isna(zip_file) and zip_file != ''
+            if zipped and Path(zip_file).exists():
+                retry_status = 'Zipped FF'
+            elif zipped and not zip_file.endswith(('.zip', '.zip.001')):
+                # A part of a multipart zip can only be uploaded again from its file
+                logging.error(f"Part {zip_file} of a failed upload is missing, zip {row['_Path']} again")
+                continue
+            else:
+                retry_status = 'Folder' if Path(row['_Path']).is_dir() else 'File'
+                if zipped and zip_file.endswith('.zip.001'):
+                    # The first part of a split zip carries the row, zip it again under its own name
+                    tasks.update(ind, {'_zipPath': zip_file[:-len('.001')], '_iPath': row['_iPath'][:-len('.001')]},
+                                 commit=False)
+            logging.info(f"Retrying the failed upload of {row['_Path']}")
+            tasks.update(ind, {'_status': retry_status}, commit=False)
+        row_dict = tasks.job(ind)
+        if row['_status'] in ['Folder', 'Zipped FF'] and config['ZIP_FOLDERS'] and not pd.isna(row['_zipPath']) \
+                and row['_zipPath'] != '':
             # Check if the folder is already zipped
-            if not pd.isna(row['_zipPath']):
-                zip_path = Path(row['_zipPath'])
-                if zip_path.exists() and row['_status'] == 'Zipped FF':
-                    logging.info(f"Found zip file: {row['_zipPath']}")
-                    to_upload_queue.put(row.to_dict())
-                    continue
-                else:
-                    # Partial zip, delete
-                    if zip_path.exists():
-                        available_diskspace += zip_path.stat().st_size
-                        zip_path.unlink()
-                        # Multipart zips
-                    if zip_path.with_suffix('.z01').exists():
-                        for file in zip_path.parent.glob(f"{zip_path.stem}.*"):
-                            available_diskspace += file.stat().st_size
-                            file.unlink()
-                    ff_to_zip_queue.put(row.to_dict())
+            zip_path = Path(row['_zipPath'])
+            if zip_path.exists() and row['_status'] == 'Zipped FF':
+                logging.info(f"Found zip file: {row['_zipPath']}")
+                to_upload.append(row_dict)
+                continue
+            # Partial zip, delete
+            for partial in [zip_path, zip_path.with_suffix('.zip.part')]:
+                if partial.exists():
+                    available_diskspace += partial.stat().st_size
+                    partial.unlink()
+            # Multipart zips
+            if zip_path.with_suffix('.z01').exists() or zip_path.with_suffix('.zip.001').exists():
+                for file in zip_path.parent.glob(f"{zip_path.stem}.*"):
+                    available_diskspace += file.stat().st_size
+                    file.unlink()
+        to_plan.append(row_dict)
+    if missing:
+        for error in missing:
+            logging.error(error)
+        exit(1)
+
+    # The uploaders start on the zips of an earlier run, in the order of JOB_ORDER
+    for row_dict in order_jobs(to_upload, [task_size(row_dict) for row_dict in to_upload], job_order):
+        to_upload_queue.put(row_dict)
+
+    # The scheduler dispatches the jobs that fit in the order of JOB_ORDER, by default the biggest first,
+    # and stops the zippers when planning is done and all jobs are dispatched
+    zip_scheduler = DiskSpaceScheduler(available_diskspace, config['NUM_ZIPPERS'], ff_to_zip_queue, job_order)
+
+    def queue_jobs(jobs: list):
+        """Queue planned jobs, the zip jobs through the scheduler and the others straight to the iRODS workers"""
+        uploads = []
+        for row_dict in jobs:
+            ind = row_dict['_row']
+            tasks.update(ind, {key: row_dict[key] for key in ['_status', '_size', '_iPath']}, commit=False)
+            if row_dict['_status'] == 'existing ipath':
+                continue
+            elif row_dict['_status'] == 'Empty folder':
+                logging.info(f"Skipping empty folder: {row_dict['Foldername']}")
+            elif row_dict['_status'] == 'Folder' and stream_zip:
+                # Zipped by the iRODS workers while uploading, no local disk space needed
+                uploads.append(row_dict)
+            elif row_dict['_status'] in ['Folder', 'Zipped FF'] and config['ZIP_FOLDERS']:
                 # Check if the folder is too large to zip
-                if row['_size'] > available_diskspace:
-                    logging.error(f"Folder {row['_Path']} is too large: {row['_size']}/{available_diskspace}")
-                    exit(1)
-        elif row['_status'] == 'Folder' and not config['ZIP_FOLDERS']:
-            # 5TB, max file size for the s3 api used by iRODS
-            if row['_size'] > FIVE_TB_FILE_LIMIT:
-                if config['ZIP_SPLIT_ABOVE_5TB'] and ZipperProcess.get_winrar_path() != "":
-                    ff_to_zip_queue.put(row.to_dict())
-                else:
-                    logging.error(f"Folder {row['_Path']} is too large for the s3api, skipping")
-                    row['_status'] == 'Skipped s3 limit'
-            else:
-                to_upload_queue.put(row.to_dict())
-        elif row['_status'] == 'File':
-            # 5TB, max file size for the s3 api used by iRODS
-            if row['_size'] > FIVE_TB_FILE_LIMIT:
-                if config['ZIP_SPLIT_ABOVE_5TB'] and ZipperProcess.get_winrar_path() != "":
-                    ff_to_zip_queue.put(row.to_dict())
+                zip_size = estimate_zip_size(row_dict['_size'], row_dict.get('_scan'))
+                if zip_size > available_diskspace:
+                    logging.error(f"Folder {row_dict['_Path']} is too large: {zip_size}/{available_diskspace}")
+                    tasks.update(ind, {'_status': 'Too large to zip'}, commit=False)
+                    continue
+                zip_scheduler.add(row_dict, zip_size)
+            elif row_dict['_status'] in ['Folder', 'File']:
+                # 5TB, max file size for the s3 api used by iRODS
+                if row_dict['_size'] > FIVE_TB_FILE_LIMIT:
+                    if config['ZIP_SPLIT_ABOVE_5TB'] and not stream_zip:
+                        zip_scheduler.add(row_dict, estimate_zip_size(row_dict['_size'], row_dict.get('_scan')))
+                    elif config['ZIP_SPLIT_ABOVE_5TB']:
+                        # Only folders are streamed, there are no zippers to split a file
+                        logging.error(f"File {row_dict['_Path']} is too large for the s3api and can't be split with "
+                                      f"ZIP_STREAM, skipping")
+                        tasks.update(ind, {'_status': 'Skipped s3 limit'}, commit=False)
+                    else:
+                        logging.error(f"Folder {row_dict['_Path']} is too large for the s3api, skipping")
+                        tasks.update(ind, {'_status': 'Skipped s3 limit'}, commit=False)
                 else:
-                    logging.error(f"Folder {row['_Path']} is too large for the s3api, skipping")
-                    row['_status'] == 'Skipped s3 limit'
-            else:
-                to_upload_queue.put(row.to_dict())
-    # Update the progress csv
-    to_upload_df.to_csv(progress_file_path, index=False)
+                    uploads.append(row_dict)
+        state.commit()
+        # The order applies within this batch only, earlier batches are queued already
+        for row_dict in order_jobs(uploads, [task_size(row_dict) for row_dict in uploads], job_order):
+            to_upload_queue.put(row_dict)
+        zip_scheduler.dispatch()
+
+    metrics.gauge('to_zip_queue_depth', ff_to_zip_queue.qsize)
+    metrics.gauge('to_upload_queue_depth', to_upload_queue.qsize)
+    metrics.gauge('zip_jobs_waiting', lambda: len(zip_scheduler.pending))
+    metrics.gauge('zip_space_budget_bytes', lambda: available_diskspace)
+    metrics.gauge('zip_space_reserved_bytes', lambda: sum(zip_scheduler.reserved.values()))
+    metrics.gauge('zip_space_free_bytes', lambda: zip_scheduler.free)
 
-    # Add the None jobs to signal the process they are done
-    for i in range(0, config['NUM_ZIPPERS']):
-        ff_to_zip_queue.put({'NONE': 'NONE'})
+    # Workers are started here and, with adaptive worker counts, while running
+    zip_retire_queue = multiprocessing.Queue()
+    upload_retire_queue = multiprocessing.Queue()
+    worker_ids = {'zipper': 0, 'iworker': 0}
+    # Bytes zipped and uploaded, counted per block by the workers, for the controllers
+    zip_progress = ProgressCounter()
+    upload_progress = ProgressCounter()
+
+    def start_zipper():
+        i = worker_ids['zipper']
+        worker_ids['zipper'] += 1
+        zipper = ZipperProcess(stop_workers,
+                               ff_to_zip_queue,
+                               events_queue,
+                               i,
+                               zip_threads,
+                               zip_retire_queue,
+                               zip_progress)
+        zipper.start()
+        metrics.worker_started(f"zipper {i}")
+        zip_processes[i] = zipper
+
+    def start_iworker():
+        i = worker_ids['iworker']
+        worker_ids['iworker'] += 1
+        iworker = ioperations.I_WORKER(ienv, password, stop_workers, to_upload_queue, events_queue, i, stream_zip,
+                                       zip_threads, config.get('SESSION_MAX_AGE', 3600),
+                                       config.get('UPLOAD_THREADS', 4),
+                                       utils.parse_filesize(config.get('BUNDLE_FILE_LIMIT', 0)),
+                                       utils.parse_filesize(config.get('BUNDLE_SIZE', '4GB')),
+                                       utils.parse_filesize(config.get('UPLOAD_CHECKPOINT_SIZE', '1GB')),
+                                       upload_retire_queue, upload_progress)
+        iworker.start()
+        metrics.worker_started(f"iworker {i}")
+        i_processes[i] = iworker
 
     # If zipping is preferred, start the processes
-    if config['ZIP_FOLDERS']:
-        free_diskspace = multiprocessing.Value('d', available_diskspace)
-        disk_space_lock = multiprocessing.Lock()
+    if config['ZIP_FOLDERS'] and not stream_zip:
         for i in range(0, config['NUM_ZIPPERS']):
-            zipper = ZipperProcess(stop_workers,
-                                   ff_to_zip_queue,
-                                   zipped_files_queue,
-                                   disk_space_lock,
-                                   free_diskspace,
-                                   i)
-            zipper.start()
-            zip_processes[i] = zipper
+            start_zipper()
 
     # Start the iRODS processes
     i_processes = {}
     for i in range(0, config['NUM_IWORKERS']):
-        iworker = ioperations.I_WORKER(ienv, password, stop_workers, to_upload_queue, uploaded_queue, i)
-        iworker.start()
-        i_processes[i] = iworker
+        start_iworker()
+
+    # Optional: adapt the number of workers to the throughput, between MIN_* and MAX_*
+    adapt_interval = config.get('ADAPT_INTERVAL', 600)
+    zip_controller = ConcurrencyController('Zippers', len(zip_processes), config.get('MIN_ZIPPERS', 1),
+                                           config.get('MAX_ZIPPERS', len(zip_processes)), adapt_interval)
+    upload_controller = ConcurrencyController('iWorkers', len(i_processes), config.get('MIN_IWORKERS', 1),
+                                              config.get('MAX_IWORKERS', len(i_processes)), adapt_interval)
 
-    # Update the progress csv as tasks are completed
-    while len(zip_processes) > 0 or len(i_processes) > 0:
-        if len(zip_processes) > 0 or zipped_files_queue.qsize() > 0:
+    def adapt_workers():
+        """Start or retire workers as the controllers decide, only while jobs can still come for their stage"""
+        if len(zip_processes) > 0 and zip_scheduler.num_zippers > 0:
+            change = zip_controller.update(zip_progress.total, zip_scheduler.backlog() > 0)
+            for i in range(0, change):
+                start_zipper()
+                zip_scheduler.num_zippers += 1
+            for i in range(0, -change):
+                zip_retire_queue.put('retire')
+            if change > 0:
+                zip_scheduler.dispatch()
+        if not uploaders_closed:
             try:
-                zipped_dfrow = zipped_files_queue.get(timeout=10)
-                if isinstance(zipped_dfrow, int):
-                    logging.info(f"Zipper {zipped_dfrow} finished")
-                    zip_processes.pop(zipped_dfrow)
-                else:
-                    row_index = to_upload_df.loc[to_upload_df['_zipPath'] == zipped_dfrow['_zipPath']].index[0]
-                    to_upload_df.at[row_index, '_status'] = 'Zipped FF'
+                backlog = to_upload_queue.qsize() > 0
+            except NotImplementedError:
+                # Queue.qsize is not available on macOS
+                backlog = True
+            change = upload_controller.update(upload_progress.total, backlog)
+            for i in range(0, change):
+                start_iworker()
+            for i in range(0, -change):
+                upload_retire_queue.put('retire')
+
+    # Check and size the remaining jobs next to the workers, the planned jobs arrive as events
+    planner = Planner(to_plan, events_queue, stop_workers, session_pool, stream_zip, config.get('SCAN_THREADS', 16),
+                      scan_cache)
+    planner.start()
+    planning_done = False
+    planned_size = 0
+    planned_count = 0
 
-                    to_upload_df = queue_multipart_zips(to_upload_queue, to_upload_df, zipped_dfrow)
-                    to_upload_df.to_csv(progress_file_path, index=False)
+    # Handle the events of the workers as they arrive, from one queue
+    uploaders_closed = False
+    finished = False
+    interrupted = False
+    try:
+        while len(zip_processes) > 0 or len(i_processes) > 0:
+            # No new upload jobs expected once planning and the zippers are done, stop the uploaders when the queue
+            # is empty
+            if planning_done and len(zip_processes) == 0 and not uploaders_closed:
+                for i in range(0, len(i_processes)):
+                    to_upload_queue.put({'NONE': 'NONE'})
+                uploaders_closed = True
+            adapt_workers()
+            try:
+                metrics.write()
+                event, worker_id, row_dict = events_queue.get(timeout=min(60, metrics.interval))
             except queue.Empty:
-                pass
+                # Workers that exited without stopping, e.g. after a failed check
+                for processes in [zip_processes, i_processes]:
+                    for worker_id, process in list(processes.items()):
+                        if not process.is_alive():
+                            logging.error(f"{process.name} stopped unexpectedly with exitcode {process.exitcode}")
+                            processes.pop(worker_id)
+                continue
 
-        # No new upload jobs expected
-        elif len(zip_processes) == 0:
-            for i in range(0, config['NUM_IWORKERS']):
+            if event == PLANNED:
+                queue_jobs(row_dict['jobs'])
+                scanned = [job['_scan'] for job in row_dict['jobs'] if job.get('_scan') is not None]
+                planned_size += sum(scan.size for scan in scanned)
+                planned_count += len(scanned)
+            elif event == PLANNER_STOPPED:
+                logging.info(f"Planning finished in {row_dict['seconds']:.1f} seconds")
+                planning_done = True
+                metrics.add('scan', planned_size, row_dict['seconds'], planned_count)
+                zip_scheduler.close()
+                state.export_csv(progress_file_path)
+            elif event == ZIPPER_STOPPED:
+                logging.info(f"Zipper {worker_id} finished")
+                zip_processes.pop(worker_id)
+                # A retired zipper no longer takes jobs, unless the zippers are being stopped already
+                if row_dict is not None and row_dict.get('retired') and zip_scheduler.num_zippers > 0:
+                    zip_scheduler.num_zippers -= 1
+                metrics.worker_stopped(f"zipper {worker_id}")
+            elif event == IWORKER_STOPPED:
+                logging.info(f"iWorker {worker_id} finished")
+                i_processes.pop(worker_id)
+                metrics.worker_stopped(f"iworker {worker_id}")
+            elif event == ZIPPED:
+                if '_row' in row_dict:
+                    row_index = row_dict['_row']
+                else:
+                    row_index = tasks.find('_zipPath', row_dict['_zipPath'])
+                # The reservation becomes the size of the parts on disk, also of leftovers of a failed zip
+                parts = utils.check_for_multipart_zip(row_dict['_zipPath'])
+                zip_size = sum(part.stat().st_size for part in parts)
+                zip_scheduler.zipped(row_index, zip_size)
+                zip_failed = row_dict['_status'] == 'Zip failed'
+                metrics.add('zip', 0 if zip_failed else task_size(tasks[row_index]), row_dict.get('_zipSeconds', 0),
+                            0 if zip_failed else 1, f"zipper {worker_id}")
+                if zip_failed:
+                    tasks.update(row_index, {'_status': 'Zip failed'})
+                    continue
+                tasks.update(row_index, {'_status': 'Zipped FF', '_checksum': row_dict.get('_checksum')})
+                queue_multipart_zips(to_upload_queue, tasks, row_dict)
+            elif event == FILES_UPLOADED:
+                # Progress of a folder that is uploaded file by file
+                state.add_files(row_dict['_row'], row_dict['files'])
+                logging.info(f"{state.count_files(row_dict['_row'])} files uploaded of "
+                             f"{tasks[row_dict['_row']]['_Path']}")
+            elif event == UPLOAD_PROGRESS:
+                # Checkpoint of a big upload, to continue from there after an interruption
+                tasks.update(row_dict['_row'], {'_uploadOffset': row_dict['_uploadOffset'],
+                                                '_uploadDigest': row_dict['_uploadDigest']})
+            elif event == UPLOADED:
+                if row_dict.get('_row') is not None:
+                    row_index = row_dict['_row']
+                else:
+                    row_index = tasks.find('_iPath', row_dict['_iPath'])
+                upload_failed = row_dict['_status'] == 'Upload failed'
+                metrics.add('upload', 0 if upload_failed else row_dict.get('_uploadBytes', 0),
+                            row_dict.get('_uploadSeconds', 0), 0 if upload_failed else 1, f"iworker {worker_id}")
+                if row_dict['_status'] == 'Metadata added':
+                    metrics.add('metadata', row_dict.get('_uploadBytes', 0), row_dict.get('_metadataSeconds', 0), 1,
+                                f"iworker {worker_id}")
+                fields = {'_status': row_dict['_status']}
+                if row_dict.get('_checksum') is not None:
+                    fields['_checksum'] = row_dict['_checksum']
+                if row_dict['_iPath'] != tasks[row_index]['_iPath']:
+                    # A streamed zip that was split, its metadata is on the first part
+                    fields['_iPath'] = row_dict['_iPath']
+                if row_dict['_status'] != 'Upload failed' and '_uploadOffset' in tasks[row_index]:
+                    fields.update({'_uploadOffset': None, '_uploadDigest': None})
+                tasks.update(row_index, fields)
+                if row_dict['_status'] == 'Upload failed':
+                    continue
+                # The other parts of a split stream are added as tasks, with their metadata added after the uploads
+                for part, part_checksum in row_dict.get('_partChecksums', {}).items():
+                    part_dict = {**tasks[row_index], '_iPath': part, '_size': 0, '_checksum': part_checksum,
+                                 '_status': 'Uploaded'}
+                    tasks.append(part_dict, commit=False)
+                tasks.state.commit()
+                # Cleanup the zip file if it was created
+                zip_file = tasks[row_index]['_zipPath']
+                if not pd.isna(zip_file) and zip_file != '':
+                    if Path(zip_file).exists():
+                        zip_size = Path(zip_file).stat().st_size
+                        Path(zip_file).unlink()
+                        zip_scheduler.release(zip_size)
+        finished = True
+    except KeyboardInterrupt:
+        # Clean shutdown, the workers ignore the interrupt and stop after their current job
+        logging.info("Interrupted, stopping the workers after their current job, interrupt again to terminate them")
+        interrupted = True
+    finally:
+        if not finished:
+            # Also when the coordinator failed, otherwise the workers keep waiting for jobs and the run hangs
+            stop_workers.set()
+            for i in range(0, len(zip_processes)):
+                ff_to_zip_queue.put({'NONE': 'NONE'})
+            for i in range(0, len(i_processes)):
                 to_upload_queue.put({'NONE': 'NONE'})
-
-        # Uploaders
-        try:
-            i_path = uploaded_queue.get(timeout=10)
-            if isinstance(i_path, int):
-                logging.info(f"iWorker {i_path} finished")
-                i_processes.pop(i_path)
+            workers = list(zip_processes.values()) + list(i_processes.values())
+            if interrupted:
+                try:
+                    for process in workers:
+                        process.join()
+                except KeyboardInterrupt:
+                    logging.info("Interrupted again, terminating the workers")
+                    for process in workers:
+                        process.terminate()
             else:
-                row_index = to_upload_df.loc[to_upload_df['_iPath'] == i_path].index[0]
-                to_upload_df.at[row_index, '_status'] = 'Uploaded'
-                to_upload_df.to_csv(progress_file_path, index=False)
-                # Cleanup the zip file if it was created
-                if not pd.isna(to_upload_df.at[row_index, '_zipPath']) and to_upload_df.at[row_index, '_zipPath'] != '':
-                    if Path(to_upload_df.at[row_index, '_zipPath']).exists():
-                        Path(to_upload_df.at[row_index, '_zipPath']).unlink()
-                        with disk_space_lock:
-                            free_diskspace.value += to_upload_df.at[row_index, '_size']
-        except queue.Empty:
-            pass
+                logging.error("The coordinator failed, terminating the workers")
+                for process in workers:
+                    process.terminate()
+            state.export_csv(progress_file_path)
+            state.close()
+            metrics.write(force=True)
+            logging.info(metrics.summary())
+    if interrupted:
+        exit(1)
     logging.info("All workers finished, proceeding with metadata")
+    state.export_csv(progress_file_path)
 
-    # Add metadata
-    for ind, row in to_upload_df.iterrows():
-        if row['_status'] == 'Uploaded':
-            ioperations.add_metadata(isession, row)
-            to_upload_df.at[ind, '_status'] = 'Metadata added'
-    to_upload_df.to_csv(progress_file_path, index=False)
+    # Add metadata that could not be added by the workers, e.g. of uploads from an earlier run or of the later parts
+    # of a split stream
+    with session_pool.session() as isession:
+        for ind, row in tasks.items():
+            if row['_status'] == 'Uploaded':
+                start_time = time()
+                try:
+                    if not ioperations.add_metadata(isession, row):
+                        continue
+                except Exception as e:
+                    # Stays 'Uploaded', the metadata is added again in the next run
+                    logging.error(f"Error adding metadata to {row['_iPath']}: {e}")
+                    continue
+                tasks.update(ind, {'_status': 'Metadata added'})
+                metrics.add('metadata', task_size(row), time() - start_time)
+    state.export_csv(progress_file_path)
 
-    # Send to tape
+    # Send to tape, the archive rules and status checks run concurrently
+    tape = TapeScheduler(session_pool, tasks, config.get('TAPE_THREADS', 4),
+                         config.get('TAPE_POLL_INTERVAL', 60), config.get('TAPE_MAX_POLL_INTERVAL', 3600))
     if args.totape or config['TO_TAPE']:
-        for ind, row in to_upload_df.iterrows():
-            if row['_status'] == 'Metadata added':
-                if ioperations.send_to_tape(isession, row):
-                    to_upload_df.at[ind, '_status'] = 'Sent to tape'
-        to_upload_df.to_csv(progress_file_path, index=False)
-
-    # Check taping status
-    for ind, row in to_upload_df.iterrows():
-        if row['_status'] == 'Sent to tape':
-            if ioperations.check_status(isession, row):
-                to_upload_df.at[ind, '_status'] = 'Archived'
-    to_upload_df.to_csv(progress_file_path, index=False)
+        start_time = time()
+        sent = tape.send()
+        sent_size = sum(task_size(row) for _, row in tasks.items() if row['_status'] == 'Sent to tape')
+        metrics.add('tape', sent_size, time() - start_time, sent)
+        state.export_csv(progress_file_path)
+
+    # Check taping status, in watch mode until everything is archived
+    if args.watch:
+        tape.watch(on_change=lambda: state.export_csv(progress_file_path))
+    else:
+        tape.poll()
+    session_pool.close()
+    state.export_csv(progress_file_path)
+    state.close()
+
+    metrics.write(force=True)
+    logging.info(metrics.summary())
 
     # Print the summary of the statuses
-    status_counts = to_upload_df['_status'].value_counts()
+    status_counts = tasks.to_frame()['_status'].value_counts()
     logging.info(status_counts)
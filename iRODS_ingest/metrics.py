@@ -0,0 +1,154 @@
+import json
+import os
+from datetime import timedelta
+from pathlib import Path
+from time import time
+
+# Stages of a run in the order of the pipeline
+STAGES = ['scan', 'zip', 'upload', 'metadata', 'tape']
+
+
+class Metrics:
+    """Throughput of the stages, queue depths, use of the zip disk space and busy time of the workers of a run.
+    Kept by the coordinator from the events of the workers and rewritten every interval seconds to
+    metrics.json and, in the Prometheus text format, to metrics.prom, e.g. for the textfile collector
+    of the node exporter. Per stage the bytes per second of one worker (bytes / busy seconds) and of
+    the whole run (bytes / seconds from the first start to the last end) are given, a stage with busy
+    workers and a low total rate is the bottleneck.
+    """
+    def __init__(self, folder: Path, interval: int = 30):
+        """
+        Args:
+            folder: Path
+                folder of metrics.json and metrics.prom
+            interval: int
+                minimum number of seconds between two writes
+        """
+        self.json_path = Path(folder).joinpath('metrics.json')
+        self.prom_path = Path(folder).joinpath('metrics.prom')
+        self.interval = interval
+        self.start_time = time()
+        self.last_write = 0
+        self.stages = {}
+        self.workers = {}
+        self.gauges = {}
+
+    def add(self, stage: str, size: int, seconds: float, items: int = 1, worker: str = None):
+        """Count finished work of a stage
+        Args:
+            stage: str
+                one of STAGES
+            size: int
+                bytes processed
+            seconds: float
+                time it took
+            items: int
+                number of files, folders or zips
+            worker: str
+                optional, worker that did the work, its busy time is increased
+        """
+        now = time()
+        counters = self.stages.setdefault(stage, {'bytes': 0, 'items': 0, 'seconds': 0.0,
+                                                  'first_start': now - seconds, 'last_end': now})
+        counters['bytes'] += int(size)
+        counters['items'] += items
+        counters['seconds'] += seconds
+        counters['first_start'] = min(counters['first_start'], now - seconds)
+        counters['last_end'] = now
+        if worker is not None:
+            self.workers.setdefault(worker, {'started': self.start_time, 'stopped': None, 'busy': 0.0})
+            self.workers[worker]['busy'] += seconds
+
+    def worker_started(self, worker: str):
+        self.workers[worker] = {'started': time(), 'stopped': None, 'busy': 0.0}
+
+    def worker_stopped(self, worker: str):
+        if worker in self.workers:
+            self.workers[worker]['stopped'] = time()
+
+    def gauge(self, name: str, value):
+        """Register a value that is read on every write, e.g. a queue depth
+        Args:
+            name: str
+                name of the metric
+            value: callable
+                returns the current value, or None when it is not known
+        """
+        self.gauges[name] = value
+
+    def snapshot(self) -> dict:
+        """Current metrics as a dict, also the content of metrics.json"""
+        now = time()
+        stages = {}
+        for stage, counters in self.stages.items():
+            wall_seconds = max(counters['last_end'] - counters['first_start'], 1e-9)
+            stages[stage] = {'bytes': counters['bytes'], 'items': counters['items'],
+                             'busy_seconds': round(counters['seconds'], 3),
+                             'bytes_per_second_per_worker': counters['bytes'] / max(counters['seconds'], 1e-9),
+                             'bytes_per_second': counters['bytes'] / wall_seconds}
+        workers = {}
+        for worker, times in self.workers.items():
+            elapsed = (times['stopped'] or now) - times['started']
+            workers[worker] = {'busy_seconds': round(times['busy'], 3),
+                               'idle_seconds': round(max(elapsed - times['busy'], 0), 3)}
+        gauges = {}
+        for name, value in self.gauges.items():
+            try:
+                gauges[name] = value()
+            except NotImplementedError:
+                # Queue.qsize is not available on macOS
+                gauges[name] = None
+        return {'time': now, 'elapsed_seconds': round(now - self.start_time, 3), 'stages': stages,
+                'workers': workers, 'gauges': gauges}
+
+    @staticmethod
+    def to_prometheus(snapshot: dict) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        stage_metrics = [('bytes', 'counter', 'bytes processed'), ('items', 'counter', 'files, folders or zips'),
+                         ('busy_seconds', 'counter', 'summed time of the workers'),
+                         ('bytes_per_second', 'gauge', 'throughput of the run')]
+        for key, kind, description in stage_metrics:
+            name = f"irods_ingest_stage_{key}" + ('_total' if kind == 'counter' else '')
+            lines += [f"# HELP {name} {description} per stage", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{stage="{stage}"}} {values[key]}' for stage, values in snapshot['stages'].items()]
+        for key in ['busy_seconds', 'idle_seconds']:
+            name = f"irods_ingest_worker_{key}_total"
+            lines += [f"# TYPE {name} counter"]
+            lines += [f'{name}{{worker="{worker}"}} {values[key]}' for worker, values in snapshot['workers'].items()]
+        for gauge, value in snapshot['gauges'].items():
+            if value is not None:
+                lines += [f"# TYPE irods_ingest_{gauge} gauge", f"irods_ingest_{gauge} {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, force: bool = False):
+        """Rewrite the metrics files when the interval passed, written to a temporary file first
+        so a reader never sees half a file"""
+        if not force and time() - self.last_write < self.interval:
+            return
+        self.last_write = time()
+        snapshot = self.snapshot()
+        for path, content in [(self.json_path, json.dumps(snapshot, indent=2)),
+                              (self.prom_path, self.to_prometheus(snapshot))]:
+            temp_path = path.with_name(path.name + '.tmp')
+            with open(temp_path, 'w', encoding='UTF-8') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+
+    def summary(self) -> str:
+        """End of run summary for the log"""
+        snapshot = self.snapshot()
+        lines = [f"Run took {timedelta(seconds=round(snapshot['elapsed_seconds']))}"]
+        for stage in STAGES:
+            if stage not in snapshot['stages']:
+                continue
+            values = snapshot['stages'][stage]
+            lines.append(f"{stage}: {values['items']} items, {values['bytes'] / 2**30:.2f}GB, "
+                         f"{values['bytes_per_second'] / 2**20:.1f}MB/s in total, "
+                         f"{values['bytes_per_second_per_worker'] / 2**20:.1f}MB/s per worker, "
+                         f"busy {timedelta(seconds=round(values['busy_seconds']))}")
+        for worker, values in snapshot['workers'].items():
+            total = values['busy_seconds'] + values['idle_seconds']
+            lines.append(f"{worker}: busy {values['busy_seconds'] / max(total, 1e-9):.0%} of "
+                         f"{timedelta(seconds=round(total))}")
+        return '\n'.join(lines)
@@ -0,0 +1,132 @@
+import logging
+import multiprocessing
+import posixpath
+import threading
+from pathlib import Path
+from time import time
+
+import pandas as pd
+
+import ioperations as ioperations
+from __init__ import PLANNED, PLANNER_STOPPED
+from scanner import ScanCache, iter_scan_paths
+
+
+def plan_tasks(jobs: list, session_pool: ioperations.SessionPool, stream_zip: bool = False,
+               num_threads: int = 16, scan_cache: ScanCache = None):
+    """Check and size the jobs, as a generator so the workers start on the first jobs while the rest is planned.
+    A job is planned once its _size is known, jobs planned in an earlier run are yielded right away.
+    Paths that exist in iRODS already get the status 'existing ipath', with one query per target collection.
+    The files are yielded together after a stat, every folder is yielded as soon as its scan is complete,
+    folders without files or subfolders get the status 'Empty folder'. Paths that can't be scanned get the status
+    'Scan failed' and are planned again in the next run.
+    Args:
+        jobs: list
+            jobs of the task table, with their row id in _row
+        session_pool: SessionPool
+            iRODS sessions, one is used to list the target collections
+        stream_zip: bool
+            folders are zipped straight into iRODS, so they are data objects in iRODS
+        num_threads: int
+            number of folders that are scanned at the same time
+        scan_cache: ScanCache
+            optional, listings of earlier runs
+    Yields:
+        list: planned jobs, with _status, _size and the scan of the file or folder in _scan
+    """
+    planned = [job for job in jobs if not pd.isna(job['_size'])]
+    to_scan = {}
+    # Check if files already exist, the content of each target collection is retrieved once
+    collection_contents = {}
+    with session_pool.session() as isession:
+        for job in jobs:
+            if not pd.isna(job['_size']):
+                continue
+            zipped = not pd.isna(job['_zipPath']) and job['_zipPath'] != ''
+            is_dataobject = zipped or stream_zip or job['_status'] == 'File'
+            if is_dataobject:
+                collection, name = posixpath.split(job['_iPath'])
+            else:
+                # A folder that is not zipped is uploaded into its _iPath, as a subcollection with its own name
+                collection, name = job['_iPath'], Path(job['_Path']).name
+            if collection not in collection_contents:
+                collection_contents[collection] = ioperations.get_collection_contents(isession, collection)
+            dataobjects, subcollections = collection_contents[collection]
+            if is_dataobject and name in dataobjects:
+                logging.info(f"File already exists: {job['_iPath']}")
+                planned.append({**job, '_status': 'existing ipath'})
+            elif job['_status'] == 'Folder' and not is_dataobject and name in subcollections:
+                logging.info(f"Folder already exist: {posixpath.join(collection, name)}")
+                planned.append({**job, '_status': 'existing ipath'})
+            else:
+                to_scan[job['_Path']] = job
+    logging.info(f"Checked {len(to_scan) + len(planned)} rows against {len(collection_contents)} iRODS collections")
+
+    # Files first, their size is a stat away
+    files = [path for path in to_scan if not Path(path).is_dir()]
+    for path, scan in iter_scan_paths(files):
+        if scan is None:
+            planned.append({**to_scan[path], '_status': 'Scan failed'})
+            continue
+        planned.append({**to_scan[path], '_size': scan.size, '_scan': scan})
+    if planned:
+        yield planned
+
+    folders = [path for path in to_scan if Path(path).is_dir()]
+    for path, scan in iter_scan_paths(folders, num_threads, scan_cache):
+        if scan is None:
+            yield [{**to_scan[path], '_status': 'Scan failed'}]
+            continue
+        job = {**to_scan[path], '_size': scan.size, '_scan': scan}
+        if scan.count == 0 and not scan.dirs:
+            job.update({'_status': 'Empty folder', '_iPath': ''})
+        yield [job]
+
+
+class Planner(threading.Thread):
+    """Runs plan_tasks next to the coordinator and sends the planned jobs to it on the events queue, like a worker.
+    The coordinator queues them for the zippers and the iRODS workers, which are started before the planner."""
+    def __init__(self, jobs: list, events_queue: multiprocessing.Queue, stop_planner: multiprocessing.Event,
+                 session_pool: ioperations.SessionPool, stream_zip: bool = False, num_threads: int = 16,
+                 scan_cache: ScanCache = None):
+        """
+        Args:
+            jobs: list
+                jobs to plan, see plan_tasks
+            events_queue: multiprocessing.Queue
+                queue of the coordinator
+            stop_planner: multiprocessing.Event
+                stops planning after the current job
+            session_pool: SessionPool
+                iRODS sessions
+            stream_zip: bool
+                folders are zipped straight into iRODS
+            num_threads: int
+                number of folders that are scanned at the same time
+            scan_cache: ScanCache
+                optional, listings of earlier runs, closed when planning is done
+        """
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.events_queue = events_queue
+        self.stop_planner = stop_planner
+        self.session_pool = session_pool
+        self.stream_zip = stream_zip
+        self.num_threads = num_threads
+        self.scan_cache = scan_cache
+
+    def run(self):
+        start_time = time()
+        try:
+            for planned in plan_tasks(self.jobs, self.session_pool, self.stream_zip, self.num_threads,
+                                      self.scan_cache):
+                if self.stop_planner.is_set():
+                    break
+                self.events_queue.put((PLANNED, 0, {'jobs': planned}))
+        except Exception as e:
+            # The jobs that are not planned keep an unknown size and are planned again in the next run
+            logging.error(f"Planning failed: {e}")
+        finally:
+            if self.scan_cache is not None:
+                self.scan_cache.close()
+            self.events_queue.put((PLANNER_STOPPED, 0, {'seconds': time() - start_time}))
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+
+class ScanResult(NamedTuple):
+    """Result of scanning a file or folder
+    size: total size of the files in bytes
+    count: number of files
+    files: list of (relative path, size) of the files, relative to the scanned folder
+    dirs: list of relative paths of the subfolders
+    """
+    size: int
+    count: int
+    files: list
+    dirs: list
+
+
+class ScanCache:
+    """SQLite cache of directory listings, to skip the metadata I/O of unchanged folders in later runs.
+    Every directory is stored with its mtime, the sizes of the files directly in it and the names of its
+    subfolders. Adding, removing or renaming an entry changes the mtime of a directory, a listing with the
+    same mtime is reused without listing the directory or stat'ing its files.
+    Note, changing the content of an existing file does not change the mtime of its directory, the cached
+    size of such a file is stale. That's why the cache is only used when SCAN_CACHE is set.
+    """
+    def __init__(self, cache_path: Path):
+        self.connection = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS listings (
+                                       path TEXT PRIMARY KEY, mtime_ns INTEGER, files TEXT, subdirs TEXT)""")
+            self.connection.commit()
+
+    def get(self, dir_path: str, mtime_ns: int):
+        """Get the cached listing of a directory
+        Args:
+            dir_path: str
+                directory
+            mtime_ns: int
+                current mtime of the directory
+        Returns:
+            tuple: list of (name, size) of the files and list of subfolder names,
+                   None if the directory is not cached or it changed
+        """
+        with self.lock:
+            cached = self.connection.execute("SELECT files, subdirs FROM listings WHERE path = ? AND mtime_ns = ?",
+                                             (os.path.abspath(dir_path), mtime_ns)).fetchone()
+        if cached is None:
+            return None
+        return json.loads(cached[0]), json.loads(cached[1])
+
+    def put(self, dir_path: str, mtime_ns: int, files: list, subdirs: list):
+        """Store the listing of a directory"""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO listings (path, mtime_ns, files, subdirs) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    (os.path.abspath(dir_path), mtime_ns, json.dumps(files), json.dumps(subdirs)))
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def scan_dir(dir_path: str, rel_path: str, cache: ScanCache = None):
+    """Scan a single directory, the stat results cached in the DirEntry are reused
+    Symlinks to files are followed, their target is zipped or uploaded like shutil.make_archive did.
+    Symlinks to folders, which can loop, broken symlinks and special files are skipped and logged.
+    Args:
+        dir_path: str
+            directory to scan
+        rel_path: str
+            path of the directory relative to the scanned root, '' for the root
+        cache: ScanCache
+            optional, listings of earlier runs
+    Returns:
+        tuple: list of (relative path, size) of the files,
+               list of (path, relative path) of the subfolders
+    """
+    prefix = f"{rel_path}/" if rel_path else ""
+    if cache is not None:
+        # The mtime is read before listing, a change during the listing invalidates the entry
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        cached = cache.get(dir_path, mtime_ns)
+        if cached is not None:
+            files, subdirs = cached
+            return ([(prefix + name, size) for name, size in files],
+                    [(os.path.join(dir_path, name), prefix + name) for name in subdirs])
+    files = []
+    subdirs = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                files.append((entry.name, entry.stat().st_size))
+            else:
+                kind = "symlink" if entry.is_symlink() else "special file"
+                logging.warning(f"Skipping {kind} {os.path.join(dir_path, entry.name)}")
+    if cache is not None:
+        cache.put(dir_path, mtime_ns, files, subdirs)
+    return ([(prefix + name, size) for name, size in files],
+            [(os.path.join(dir_path, name), prefix + name) for name in subdirs])
+
+
+def iter_scan_paths(paths: list, num_threads: int = 16, cache: ScanCache = None):
+    """Scan files and folders with os.scandir, all directories are scanned in parallel with one thread pool.
+    Every path is yielded as soon as it is scanned completely, files right away, so its job can start
+    while the other folders are still being scanned. A path that can't be scanned, e.g. without permission or
+    removed in the meantime, is logged and yielded without a result, the other paths are still scanned.
+    Args:
+        paths: list
+            files and folders to scan
+        num_threads: int
+            number of directories that are scanned at the same time
+        cache: ScanCache
+            optional, cache to reuse the listings of unchanged directories from earlier runs
+    Yields:
+        tuple: the path as it was passed, its ScanResult or None when it could not be scanned
+    """
+    files = {}
+    dirs = {}
+    # Directories of each root that are not scanned yet
+    unscanned = {}
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = {}
+        for path in paths:
+            if Path(path).is_dir():
+                files[path] = []
+                dirs[path] = []
+                unscanned[path] = 1
+                pending[executor.submit(scan_dir, str(path), '', cache)] = path
+            else:
+                try:
+                    size = Path(path).stat().st_size
+                except OSError as e:
+                    logging.error(f"Can't scan {path}: {e}")
+                    yield path, None
+                    continue
+                yield path, ScanResult(size, 1, [(Path(path).name, size)], [])
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root = pending.pop(future)
+                    if root not in files:
+                        # Another directory of the root could not be scanned
+                        continue
+                    try:
+                        dir_files, subdirs = future.result()
+                    except Exception as e:
+                        logging.error(f"Can't scan {root}: {e}")
+                        files.pop(root)
+                        dirs.pop(root)
+                        yield root, None
+                        continue
+                    files[root].extend(dir_files)
+                    unscanned[root] += len(subdirs) - 1
+                    for subdir, rel_path in subdirs:
+                        dirs[root].append(rel_path)
+                        pending[executor.submit(scan_dir, subdir, rel_path, cache)] = root
+                    if unscanned[root] == 0:
+                        root_files, root_dirs = files.pop(root), dirs.pop(root)
+                        yield root, ScanResult(sum(size for _, size in root_files), len(root_files),
+                                               sorted(root_files), sorted(root_dirs))
+        finally:
+            # The caller stopped early, don't scan the rest
+            for future in pending:
+                future.cancel()
+    if cache is not None:
+        cache.commit()
+
+
+def scan_paths(paths: list, num_threads: int = 16, cache: ScanCache = None) -> dict:
+    """Scan files and folders with os.scandir, all directories are scanned in parallel with one thread pool
+    Args:
+        paths: list
+            files and folders to scan
+        num_threads: int
+            number of directories that are scanned at the same time
+        cache: ScanCache
+            optional, cache to reuse the listings of unchanged directories from earlier runs
+    Returns:
+        dict: ScanResult for each path, None when it could not be scanned, with the path as it was passed as key
+    """
+    start_time = datetime.now()
+    results = dict(iter_scan_paths(paths, num_threads, cache))
+    logging.info(f"Scanned {len(paths)} paths in {datetime.now() - start_time}")
+    return results
+
+
+def scan_folder(folder_path: str, num_threads: int = 16, cache: ScanCache = None) -> ScanResult:
+    """Scan a single file or folder, see scan_paths. Raises an IOError when it can't be scanned"""
+    scan = scan_paths([folder_path], num_threads, cache)[folder_path]
+    if scan is None:
+        raise IOError(f"Can't scan {folder_path}")
+    return scan
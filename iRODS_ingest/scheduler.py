@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+
+from scanner import ScanResult
+
+# Headers, data descriptor and central directory record of a zip entry, plus room for the name
+ZIP_ENTRY_OVERHEAD = 512
+
+# Orders in which the jobs are handed to the workers, see order_jobs
+JOB_ORDERS = ['longest_zip_first', 'interleave', 'row']
+
+
+def order_jobs(jobs: list, sizes: list, order: str = 'longest_zip_first') -> list:
+    """Order the jobs that go straight to the iRODS workers.
+    With longest_zip_first the zippers start on the biggest folders while the uploaders drain the smallest
+    jobs first, so both stages are busy from the start and the run takes about as long as the slowest stage.
+    The jobs are ordered per batch as the planner delivers them, not over the whole run, see plan_tasks.
+    Args:
+        jobs: list
+            jobs for the iRODS workers, with their row id in _row
+        sizes: list
+            size in bytes of every job, the recorded _size
+        order: str
+            one of JOB_ORDERS: smallest first (longest_zip_first), alternating the largest and the smallest
+            (interleave) or the order of the Excel (row)
+    Returns:
+        list: the jobs in the order to queue them
+    """
+    if order == 'row':
+        return sorted(jobs, key=lambda job: job['_row'])
+    ascending = [jobs[i] for i in sorted(range(len(jobs)), key=lambda i: sizes[i])]
+    if order == 'longest_zip_first':
+        return ascending
+    ordered = []
+    while ascending:
+        ordered.append(ascending.pop())
+        if ascending:
+            ordered.append(ascending.pop(0))
+    return ordered
+
+
+def estimate_zip_size(size: int, scan: ScanResult = None) -> int:
+    """Upper limit of the size of a zip, stored files are not smaller than the original
+    Args:
+        size: int
+            total size of the files to zip
+        scan: ScanResult
+            optional, scan of the folder to count its entries
+    Returns:
+        int: bytes to reserve for the zip
+    """
+    num_entries = len(scan.files) + len(scan.dirs) if scan is not None else 1
+    return size + num_entries * ZIP_ENTRY_OVERHEAD
+
+
+class DiskSpaceScheduler:
+    """Hands out the zip jobs to the zippers within the budget of the zip temp area.
+    Every job reserves the estimated size of its zip when it is dispatched. Once zipped the reservation
+    is corrected to the size of all parts on disk, and the space is released part by part as the parts
+    are uploaded and deleted. Each release dispatches new jobs right away, picking the largest job that
+    fits in the free space (best fit) so one huge folder does not block the smaller ones.
+    Only as many jobs as there are zippers are dispatched at a time, the rest waits here for the best fit.
+    The order changes which fitting job goes first: the largest (longest_zip_first), alternately the largest
+    and the smallest (interleave), or the first in the Excel (row).
+    """
+    def __init__(self, budget: int, num_zippers: int, to_zip_queue: multiprocessing.Queue,
+                 order: str = 'longest_zip_first'):
+        """
+        Args:
+            budget: int
+                free bytes in the zip temp area
+            num_zippers: int
+                number of zip processes, which also stop on the sentinels of this scheduler
+            to_zip_queue: multiprocessing.Queue
+                queue of the zippers
+            order: str
+                one of JOB_ORDERS
+        """
+        self.free = budget
+        self.num_zippers = num_zippers
+        self.to_zip_queue = to_zip_queue
+        self.pending = []
+        self.reserved = {}
+        self.closing = False
+        self.order = order
+        self.take_largest = True
+
+    def add(self, job: dict, size: int):
+        """Add a job that waits for disk space
+        Args:
+            job: dict
+                job for the zippers, with its row id in _row
+            size: int
+                bytes to reserve, see estimate_zip_size
+        """
+        self.pending.append((size, job))
+
+    def backlog(self) -> int:
+        """Number of waiting jobs that fit in the free space. Jobs that wait for disk space are left out,
+        more zippers would not start them sooner"""
+        return sum(1 for size, _ in self.pending if size <= self.free)
+
+    def close(self):
+        """No more jobs will be added, the zippers are stopped once every job is dispatched"""
+        self.closing = True
+        self.dispatch()
+
+    def dispatch(self) -> int:
+        """Dispatch the jobs that fit in the free space to idle zippers
+        Returns:
+            int: number of dispatched jobs
+        """
+        dispatched = 0
+        while len(self.reserved) < self.num_zippers and self.pending:
+            fitting = [i for i, (size, _) in enumerate(self.pending) if size <= self.free]
+            if not fitting:
+                logging.info(f"Not enough free diskspace for the {len(self.pending)} waiting zip jobs, "
+                             f"{self.free} bytes free")
+                break
+            size, job = self.pending.pop(self.pick(fitting))
+            self.free -= size
+            self.reserved[job['_row']] = size
+            self.to_zip_queue.put(job)
+            dispatched += 1
+        if self.closing and not self.pending and self.num_zippers > 0:
+            # Sentinel values to indicate the end of the queue
+            for i in range(0, self.num_zippers):
+                self.to_zip_queue.put({'NONE': 'NONE'})
+            self.num_zippers = 0
+        return dispatched
+
+    def pick(self, fitting: list) -> int:
+        """Choose one of the jobs that fit in the free space
+        Args:
+            fitting: list
+                indices in pending of the jobs that fit
+        Returns:
+            int: index in pending of the job to dispatch
+        """
+        if self.order == 'row':
+            return min(fitting, key=lambda i: self.pending[i][1]['_row'])
+        if self.order == 'interleave':
+            largest = self.take_largest
+            self.take_largest = not largest
+            if not largest:
+                return min(fitting, key=lambda i: self.pending[i][0])
+        return max(fitting, key=lambda i: self.pending[i][0])
+
+    def zipped(self, row_id: int, zip_size: int):
+        """A zipper finished a job, the reservation becomes the size of the zip on disk
+        Args:
+            row_id: int
+                row id of the job
+            zip_size: int
+                size of all parts of the zip, 0 if zipping failed and the parts were removed
+        """
+        self.free += self.reserved.pop(row_id) - zip_size
+        self.dispatch()
+
+    def release(self, size: int):
+        """An uploaded zip, or part of it, was deleted from the zip temp area"""
+        self.free += size
+        self.dispatch()
@@ -0,0 +1,192 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+
+def to_sql_value(value):
+    """Convert pandas/numpy values to values sqlite can store"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+class StateStore:
+    """Progress state of the tasks in a SQLite table.
+    Every status change is a single UPDATE of one row in a transaction, instead of a rewrite of
+    the whole progress csv. The csv can still be exported for people who like to open it in Excel.
+    The row ids are the index of the task dataframe.
+    Folders that are uploaded file by file have their uploaded files in a separate table.
+    """
+    table = 'tasks'
+    files_table = 'files'
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.connection = sqlite3.connect(str(self.db_path))
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{self.files_table}" ('
+                                '"_row" INTEGER, path TEXT, size INTEGER, checksum TEXT, PRIMARY KEY ("_row", path))')
+        self.connection.commit()
+        self.columns = self.get_columns()
+
+    def get_columns(self) -> list:
+        """Columns of the task table, empty if there is no table yet"""
+        return [info[1] for info in self.connection.execute(f'PRAGMA table_info("{self.table}")')]
+
+    def has_tasks(self) -> bool:
+        """Check if the store contains a task table"""
+        return len(self.columns) > 0
+
+    def save(self, df: pd.DataFrame):
+        """Store a full snapshot of the task dataframe, replacing the previous state"""
+        with self.connection:
+            df.to_sql(self.table, self.connection, if_exists='replace', index=True, index_label='_row')
+        self.columns = self.get_columns()
+        logging.info(f"Saved the state of {len(df)} tasks in {self.db_path}")
+
+    def load(self) -> pd.DataFrame:
+        """Load the task dataframe"""
+        df = pd.read_sql(f'SELECT * FROM "{self.table}"', self.connection, index_col='_row')
+        df.index.name = None
+        return df
+
+    def add_columns(self, columns):
+        """Add the columns that are not yet in the table"""
+        for col in columns:
+            if col not in self.columns:
+                self.connection.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{col}"')
+                self.columns.append(col)
+
+    def update(self, row_id: int, fields: dict, commit: bool = True):
+        """Update fields of a single task
+        Args:
+            row_id: int
+                index of the task in the dataframe
+            fields: dict
+                column: value to update
+            commit: bool
+                commit the transaction, disable to group many updates with commit()
+        """
+        self.add_columns(fields.keys())
+        assignments = ', '.join(f'"{col}" = ?' for col in fields.keys())
+        self.connection.execute(f'UPDATE "{self.table}" SET {assignments} WHERE "_row" = ?',
+                                [to_sql_value(value) for value in fields.values()] + [int(row_id)])
+        if commit:
+            self.connection.commit()
+
+    def insert(self, row_id: int, row: dict, commit: bool = True):
+        """Add a task, e.g. a part of a multipart zip
+        Args:
+            row_id: int
+                index of the task in the dataframe
+            row: dict
+                column: value of the new task
+            commit: bool
+                commit the transaction, disable to group many inserts with commit()
+        """
+        self.add_columns(row.keys())
+        columns = ', '.join(f'"{col}"' for col in row.keys())
+        placeholders = ', '.join('?' for _ in row.keys())
+        self.connection.execute(f'INSERT INTO "{self.table}" ("_row", {columns}) VALUES (?, {placeholders})',
+                                [int(row_id)] + [to_sql_value(value) for value in row.values()])
+        if commit:
+            self.connection.commit()
+
+    def add_files(self, row_id: int, files: list, commit: bool = True):
+        """Store the uploaded files of a folder
+        Args:
+            row_id: int
+                index of the task in the dataframe
+            files: list
+                (relative path, size, checksum) of the uploaded files
+            commit: bool
+                commit the transaction, disable to group many updates with commit()
+        """
+        self.connection.executemany(f'INSERT OR REPLACE INTO "{self.files_table}" VALUES (?, ?, ?, ?)',
+                                    [(int(row_id), path, size, checksum) for path, size, checksum in files])
+        if commit:
+            self.connection.commit()
+
+    def count_files(self, row_id: int) -> int:
+        """Number of uploaded files of a folder"""
+        return self.connection.execute(f'SELECT COUNT(*) FROM "{self.files_table}" WHERE "_row" = ?',
+                                       (int(row_id),)).fetchone()[0]
+
+    def commit(self):
+        self.connection.commit()
+
+    def export_csv(self, csv_path: Path):
+        """Export the state to the progress csv, written to a temporary file first so a crash
+        halfway never leaves a broken csv behind"""
+        temp_path = Path(csv_path).with_name(Path(csv_path).name + '.tmp')
+        self.load().to_csv(temp_path, index=False)
+        os.replace(temp_path, csv_path)
+
+    def close(self):
+        self.connection.close()
+
+
+class TaskTable:
+    """In memory task table of the coordinator.
+    Rows are dicts keyed by their stable row id, with hash indexes on the path columns so a status
+    update is a constant time lookup instead of a scan of the dataframe. Every change is also
+    stored in the StateStore.
+    """
+    def __init__(self, df: pd.DataFrame, state: StateStore, index_columns: tuple = ('_iPath', '_zipPath')):
+        self.state = state
+        self.rows = df.to_dict('index')
+        self.next_id = max(self.rows.keys(), default=-1) + 1
+        self.indexes = {col: {} for col in index_columns}
+        for row_id, row in self.rows.items():
+            self.add_to_indexes(row_id, row)
+
+    def add_to_indexes(self, row_id: int, row: dict):
+        for col, index in self.indexes.items():
+            if isinstance(row.get(col), str) and row[col] != '':
+                index[row[col]] = row_id
+
+    def __getitem__(self, row_id: int) -> dict:
+        return self.rows[row_id]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def items(self):
+        """Iterate over (row id, row), rows appended while iterating are not included"""
+        return list(self.rows.items())
+
+    def find(self, col: str, value: str) -> int:
+        """Row id of the task with the value in an indexed column"""
+        return self.indexes[col][value]
+
+    def job(self, row_id: int) -> dict:
+        """Copy of a task to send to the workers, the row id travels along with it"""
+        job = dict(self.rows[row_id])
+        job['_row'] = row_id
+        return job
+
+    def update(self, row_id: int, fields: dict, commit: bool = True):
+        """Update fields of a task and store the change"""
+        self.rows[row_id].update(fields)
+        self.add_to_indexes(row_id, fields)
+        self.state.update(row_id, fields, commit)
+
+    def append(self, row: dict, commit: bool = True) -> int:
+        """Add a task, e.g. a part of a multipart zip
+        Returns:
+            int: row id of the new task
+        """
+        row_id = self.next_id
+        self.next_id += 1
+        self.rows[row_id] = row
+        self.add_to_indexes(row_id, row)
+        self.state.insert(row_id, row, commit)
+        return row_id
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame.from_dict(self.rows, orient='index')
@@ -0,0 +1,116 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep
+
+import ioperations as ioperations
+from state import TaskTable
+
+
+class TapeScheduler:
+    """Tape phase: fires the archive rules concurrently and checks the archive status in batches,
+    with one query per collection instead of two round trips per data object"""
+    def __init__(self, session_pool: ioperations.SessionPool, tasks: TaskTable, num_threads: int = 4,
+                 poll_interval: int = 60, max_poll_interval: int = 3600):
+        """
+        Args:
+            session_pool: SessionPool
+                iRODS sessions for the threads
+            tasks: TaskTable
+                tasks to send to tape, their status is updated
+            num_threads: int
+                number of archive rules or status queries that run at the same time
+            poll_interval: int
+                seconds between status checks in watch mode
+            max_poll_interval: int
+                upper limit of the interval, which doubles while nothing gets archived
+        """
+        self.session_pool = session_pool
+        self.tasks = tasks
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    def _send(self, row: dict) -> bool:
+        with self.session_pool.session() as session:
+            return ioperations.send_to_tape(session, row)
+
+    def _get_states(self, collection: str) -> dict:
+        with self.session_pool.session() as session:
+            return ioperations.get_archive_states(session, collection)
+
+    def send(self) -> int:
+        """Fire the archive rule for all tasks with metadata
+        Returns:
+            int: number of tasks sent to tape
+        """
+        rows = [(ind, row) for ind, row in self.tasks.items() if row['_status'] == 'Metadata added']
+        sent = 0
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            futures = {executor.submit(self._send, row): ind for ind, row in rows}
+            # The task table is only updated from this thread
+            for future in as_completed(futures):
+                ind = futures[future]
+                try:
+                    if future.result():
+                        self.tasks.update(ind, {'_status': 'Sent to tape'})
+                        sent += 1
+                except Exception as e:
+                    logging.error(f"Sending to tape failed for {self.tasks[ind]['_iPath']}: {e}")
+        logging.info(f"Sent {sent}/{len(rows)} objects to tape")
+        return sent
+
+    def poll(self) -> int:
+        """Check the archive status and replica states of all tasks sent to tape,
+        archived tasks get the status 'Archived'
+        Returns:
+            int: number of tasks that are not yet archived
+        """
+        collections = {}
+        for ind, row in self.tasks.items():
+            if row['_status'] == 'Sent to tape':
+                collection, name = posixpath.split(row['_iPath'])
+                collections.setdefault(collection, []).append((ind, name))
+        pending = 0
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            futures = {executor.submit(self._get_states, collection): collection for collection in collections}
+            for future in as_completed(futures):
+                collection = futures[future]
+                try:
+                    states = future.result()
+                except Exception as e:
+                    logging.error(f"Checking the archive status of {collection} failed: {e}")
+                    pending += len(collections[collection])
+                    continue
+                for ind, name in collections[collection]:
+                    archive_status, replica_states = states.get(name, (None, set()))
+                    # status can be: stale, good, intermediate, write-locked
+                    if archive_status == 'completed_and_hot_deleted' and replica_states == {'good'}:
+                        self.tasks.update(ind, {'_status': 'Archived'})
+                    else:
+                        pending += 1
+        return pending
+
+    def watch(self, on_change=None) -> int:
+        """Keep checking until every task sent to tape is archived.
+        The interval doubles while nothing gets archived, up to max_poll_interval
+        Args:
+            on_change: callable
+                optional, called after a check that archived tasks, e.g. to export the progress csv
+        Returns:
+            int: number of tasks that are not yet archived, always 0
+        """
+        interval = self.poll_interval
+        pending = self.poll()
+        while pending > 0:
+            logging.info(f"{pending} objects are not yet archived, checking again in {interval} seconds")
+            sleep(interval)
+            still_pending = self.poll()
+            if still_pending < pending:
+                interval = self.poll_interval
+                if on_change is not None:
+                    on_change()
+            else:
+                interval = min(interval * 2, self.max_poll_interval)
+            pending = still_pending
+        return pending
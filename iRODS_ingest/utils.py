@@ -1,3 +1,4 @@
+import glob
 import sys
 import logging
 from logging.handlers import RotatingFileHandler
@@ -31,31 +32,15 @@ def parse_filesize(sizestr: str):
     return int(number*units[unit])
 
 
-def get_ffsize(file_folder_path: str):
-    """Get the size of a file or folder in bytes"""
-    if Path(file_folder_path).is_dir():
-        return get_folder_size(file_folder_path)
-    return Path(file_folder_path).stat().st_size
-
-
-def get_folder_size(folder_path: str):
-    """Get the size of a folder"""
-    total_size = 0
-    start_time = datetime.now()
-    for path in Path(folder_path).rglob('*'):
-        if path.is_file() and not path.is_symlink():
-            total_size += path.stat().st_size
-    logging.info(f"Computed size of {folder_path} in {datetime.now() - start_time}")
-    return total_size
-
-
 def check_for_multipart_zip(zip_path: str):
-    """Check if a zip is multipart and return the partnumbers if there are any"""
+    """Check if a zip is multipart and return its parts in order, winrar parts (.z01, ..., .zip) or
+    parts of the builtin zip engine (.zip.001, .zip.002, ...). zip_path is the .zip or the first part, .zip.001.
+    Only these names count as parts, other files with the same stem, e.g. name.v2.zip, are not"""
     path = Path(zip_path)
-    parts = []
-    for file in path.parent.glob(f"{path.stem}.*"):
-        parts.append(file)
-    return parts
+    if re.fullmatch(r'\.\d{3,}', path.suffix):
+        path = path.with_suffix('')
+    part_name = re.compile(re.escape(path.stem) + r'\.(zip|zip\.\d{3,}|z\d{2,})')
+    return sorted(file for file in path.parent.glob(glob.escape(path.stem) + '.*') if part_name.fullmatch(file.name))
 
 
 def setup_logger(filename='iRODS_upload'):
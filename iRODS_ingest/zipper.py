@@ -1,70 +1,85 @@
 import multiprocessing
-import shutil
 import logging
 import os
+import signal
 from datetime import datetime
-from time import sleep
-from zipfile import ZipFile, BadZipFile
+from pathlib import Path
 from subprocess import run, CalledProcessError, PIPE
 
-from __init__ import FIVE_TB_FILE_LIMIT
+from __init__ import FIVE_TB_FILE_LIMIT, ZIPPED, ZIPPER_STOPPED
+from controller import ProgressCounter, retire_requested
+from zipwriter import ConcatReader, LocalSplitWriter, zip_folder, summarize_methods, verify_archive
 
 
 class ZipperProcess(multiprocessing.Process):
     """Process to zip files"""
     def __init__(self, stop_worker: multiprocessing.Event,
                  files_to_zip_queue: multiprocessing.Queue,
-                 zipped_files_queue: multiprocessing.Queue,
-                 disk_space_lock: multiprocessing.Lock,
-                 free_diskspace: multiprocessing.Value,
-                 id: int):
+                 events_queue: multiprocessing.Queue,
+                 id: int,
+                 num_threads: int = 1,
+                 retire_queue: multiprocessing.Queue = None,
+                 progress: ProgressCounter = None):
         super().__init__()
         self.files_to_zip_queue = files_to_zip_queue
-        self.zipped_files_queue = zipped_files_queue
+        self.events_queue = events_queue
         self.stop_worker = stop_worker
-        self.disk_space_lock = disk_space_lock
-        self.free_diskspace = free_diskspace
         self.id = id
+        self.retire_queue = retire_queue
+        self.num_threads = num_threads
+        # Bytes zipped, for the controller of the number of zippers
+        self.progress = progress
 
-        # check for winrar
-        self.winrar_path = self.get_winrar_path()
+        # check for winrar, rar on linux can't create zip files so there the builtin zip engine is used
+        self.winrar_path = self.get_winrar_path() if os.name == 'nt' else ""
         if self.winrar_path:
             logging.info("WinRAR detected")
 
     def run(self):
+        # The coordinator handles interrupts and stops the workers with stop_worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         while not self.stop_worker.is_set():
+            if retire_requested(self.retire_queue):
+                logging.info("Retiring ZipperProcess %d", self.id)
+                self.events_queue.put((ZIPPER_STOPPED, self.id, {'retired': True}))
+                break
             row_dict = self.files_to_zip_queue.get()
             if 'NONE' in row_dict.keys() or self.stop_worker.is_set():
                 # Sentinel value to indicate the end of the queue
                 logging.info("Stopping ZipperProcess %d", self.id)
-                self.zipped_files_queue.put(self.id)
+                self.events_queue.put((ZIPPER_STOPPED, self.id, None))
                 break
+            # The file list of the scan is only needed here, don't send it back
+            scan = row_dict.pop('_scan', None)
+            # The disk space is reserved by the DiskSpaceScheduler of the coordinator
             try:
-                while True:
-                    with self.disk_space_lock:
-                        if row_dict['_size'] <= self.free_diskspace.value:
-                            self.free_diskspace.value -= row_dict['_size']
-                            break
-                    logging.info("%d Not enough free diskspace, waiting for more", self.id)
-                    sleep(300)
                 start_time = datetime.now()
+                methods = "winrar"
                 if self.winrar_path:
                     status = self.zip_file_with_winrar(row_dict['_Path'], row_dict['_zipPath'])
-                elif row_dict['_size'] <= FIVE_TB_FILE_LIMIT:
-                    # python zipfunctions don't support multipart zips...
-                    status = self.zip_file_with_shutil(row_dict['_Path'], row_dict['_zipPath'])
                 else:
-                    raise Exception(f"File {row_dict['_Path']} is too large to zip without winrar, skipping")
-                logging.info(f"Zipper {self.id} zipped {row_dict['_Path']} in {datetime.now() - start_time}")
+                    parts, checksums, entries = self.zip_file_with_python(row_dict['_Path'], row_dict['_zipPath'], scan)
+                    status = len(parts) > 0
+                    methods = summarize_methods(entries)
+                # Time it took, for the metrics of the coordinator
+                row_dict['_zipSeconds'] = (datetime.now() - start_time).total_seconds()
+                logging.info(f"Zipper {self.id} zipped {row_dict['_Path']} in {datetime.now() - start_time}, {methods}")
                 if status and self.winrar_path and self.check_winrar_zip(row_dict['_zipPath']):
-                    self.zipped_files_queue.put(row_dict)
-                elif status and self.check_zip(row_dict['_zipPath']):
-                    self.zipped_files_queue.put(row_dict)
+                    self.events_queue.put((ZIPPED, self.id, row_dict))
+                elif status and not self.winrar_path and self.check_zip(parts, entries):
+                    # Checksums computed while zipping, compared with the iRODS checksums after the upload
+                    row_dict['_checksum'] = checksums[0]
+                    row_dict['_partChecksums'] = {str(part): checksum for part, checksum in zip(parts, checksums)}
+                    self.events_queue.put((ZIPPED, self.id, row_dict))
                 else:
-                    logging.error(f"Zipper {self.id} failed to zip {row_dict['_Path']}")
-                    exit(1)
+                    # Reported as a failed zip below, so the coordinator frees the reservation
+                    raise IOError(f"Zipper {self.id} failed to zip or check {row_dict['_zipPath']}")
             except Exception as e:
                 logging.error(f"Error zipping file {row_dict['_Path']}: {e}")
+                # Frees the reservation of the job
+                row_dict['_status'] = 'Zip failed'
+                row_dict['_zipSeconds'] = (datetime.now() - start_time).total_seconds()
+                self.events_queue.put((ZIPPED, self.id, row_dict))
 
     @staticmethod
     def get_winrar_path() -> str:
@@ -85,7 +100,7 @@ class ZipperProcess(multiprocessing.Process):
             if result.returncode == 0:
                 winrar_path = result.stdout.strip()
                 logging.info(f"WinRAR is installed at: {winrar_path}")
-                return winrar_path + os.sep + "winrar"
+                return winrar_path
             else:
                 logging.error("WinRAR is not installed or not found in PATH.")
                 return ""
@@ -118,37 +133,41 @@ class ZipperProcess(multiprocessing.Process):
             logging.error(f"Failed to zip file {local_path}: {e}")
         return False
 
-    def zip_file_with_shutil(self, local_path: str, zip_path: str) -> bool:
-        """Zip a file using shutil
+    def zip_file_with_python(self, local_path: str, zip_path: str, scan=None) -> tuple:
+        """Zip a folder with the builtin multi-threaded zip engine, with the same layout as shutil.make_archive
+        Archives above 5TB are split in parts name.zip.001, name.zip.002, ..., see SplitWriter
         Args:
             local_path: str
-                path to the file to zip
+                path to the folder to zip
             zip_path: str
                 path to the zip file
+            scan: ScanResult
+                optional, file list of the folder from the size scan
         Returns:
-            bool: True if succesfull
+            tuple: paths of the parts, the first one gets the metadata, their checksums and the archive entries
         """
-        # Shutil adds zip extension automatically
-        zip_root, _ = os.path.splitext(zip_path)
-        shutil.make_archive(zip_root, 'zip', local_path)
-        return True
-
-    def check_zip(self, zip_path: str) -> bool:
-        """Check if the zip file is valid
+        writer = LocalSplitWriter(Path(zip_path), FIVE_TB_FILE_LIMIT)
+        try:
+            entries = zip_folder(local_path, writer, scan, self.num_threads,
+                                 self.progress.add if self.progress is not None else None)
+        except BaseException:
+            writer.discard()
+            raise
+        return writer.finish(), writer.checksums, entries
+
+    def check_zip(self, parts: list, entries: list) -> bool:
+        """Check if the zip file is valid, by comparing its central directory with the entries that were written.
+        The data is not read again, its CRCs and checksums were computed while zipping
         Args:
-            zip_path: str
-                path to the zip file
+            parts: list
+                paths of the parts of the zip, in order
+            entries: list[ZipInfo]
+                entries written by zip_folder
         Returns:
             bool: True if the zip file is valid
         """
-        try:
-            with ZipFile(zip_path, 'r') as zip_ref:
-                bad_file = zip_ref.testzip()
-                if bad_file:
-                    return False
-        except BadZipFile:
-            return False
-        return True
+        with ConcatReader([open(part, 'rb') for part in parts]) as reader:
+            return verify_archive(reader, entries)
 
     def check_winrar_zip(self, zip_path: str) -> bool:
         """Check if the rar file is valid, as python does not support multipart zips
@@ -174,17 +193,17 @@ class ZipperProcess(multiprocessing.Process):
 # Example usage
 if __name__ == "__main__":
     files_to_zip_queue = multiprocessing.Queue()
-    zipped_files_queue = multiprocessing.Queue()
+    events_queue = multiprocessing.Queue()
 
     # Add files to the queue
     files_to_zip_queue.put("example1.txt")
     files_to_zip_queue.put("example2.txt")
     files_to_zip_queue.put(None)  # Sentinel value to stop the process
 
-    zipper = ZipperProcess(files_to_zip_queue, zipped_files_queue)
+    zipper = ZipperProcess(multiprocessing.Event(), files_to_zip_queue, events_queue, 0)
     zipper.start()
     zipper.join()
 
     # Retrieve zipped files from the queue
-    while not zipped_files_queue.empty():
-        print(zipped_files_queue.get())
+    while not events_queue.empty():
+        print(events_queue.get())
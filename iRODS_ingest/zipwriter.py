@@ -0,0 +1,504 @@
+import base64
+import bisect
+import hashlib
+import io
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import (ZipFile, ZipInfo, BadZipFile, LargeZipFile, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT, ZIP64_VERSION,
+                     ZIP_FILECOUNT_LIMIT, DEFAULT_VERSION, structCentralDir, stringCentralDir,
+                     structEndArchive64, stringEndArchive64, structEndArchive64Locator,
+                     stringEndArchive64Locator, structEndArchive, stringEndArchive)
+
+from __init__ import FIVE_TB_FILE_LIMIT
+from scanner import ScanResult, scan_folder
+
+# Files are compressed in blocks of this size, so big files are spread over the threads as well
+BLOCK_SIZE = 4 * 2**20
+# Formats that are compressed already, deflating them costs cpu time for almost no gain
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.jp2', '.heic', '.mp4', '.mkv', '.avi', '.mov',
+                     '.mp3', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst'}
+# Other files are probed by deflating a sample, files that shrink less than PROBE_MIN_SAVING are stored
+PROBE_SIZE = 2**16
+PROBE_MIN_SAVING = 0.1
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+DATA_DESCRIPTOR_FLAG = 0x08
+UTF8_FILENAME_FLAG = 0x800
+
+
+class SplitWriter(io.RawIOBase):
+    """Write only stream that splits its output in parts of at most part_size bytes.
+    An archive that fits in one part is name.zip, a bigger one is a raw split in name.zip.001, name.zip.002, ...
+    These parts are one archive cut in pieces, not a spanned zip: concatenate them to restore name.zip.
+    The part being written is kept under a temporary name, so an interrupted write never
+    leaves a complete looking zip behind. Subclasses implement the storage specific calls.
+    The SHA-256 and MD5 of every part are computed while writing, in the iRODS checksum format."""
+    def __init__(self, zip_path, part_size: int = FIVE_TB_FILE_LIMIT):
+        super().__init__()
+        self.zip_path = zip_path
+        self.part_size = part_size
+        self.parts = []
+        self.checksums = []
+        self.digest = Digest()
+        self.position = 0
+        self.part_written = 0
+        self.handle = self._open_part(self._temp_path())
+
+    def _temp_path(self):
+        """Name under which the part that is being written is stored"""
+        return self._with_suffix(self.zip_path, ".zip.part")
+
+    def _with_suffix(self, path, suffix: str):
+        raise NotImplementedError
+
+    def _open_part(self, path):
+        raise NotImplementedError
+
+    def _rename_part(self, source, target):
+        raise NotImplementedError
+
+    def _part_path(self, number: int):
+        """Name of a part of a split archive, numbered from 1"""
+        return self._with_suffix(self.zip_path, f".zip.{number:03d}")
+
+    def _close_part(self, part_path):
+        """Close the current part and give it its final name"""
+        self.handle.close()
+        self._rename_part(self._temp_path(), part_path)
+        self.parts.append(part_path)
+        self.checksums.append(irods_checksum(self.digest))
+
+    def _next_part(self):
+        """Close the current part under its .NNN name and continue in a new one"""
+        self._close_part(self._part_path(len(self.parts) + 1))
+        self.digest = Digest()
+        self.part_written = 0
+        self.handle = self._open_part(self._temp_path())
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        written = 0
+        while written < len(view):
+            if self.part_written == self.part_size:
+                self._next_part()
+            chunk = view[written:written + min(len(view) - written, self.part_size - self.part_written)]
+            self.handle.write(chunk)
+            self.digest.update(chunk)
+            self.part_written += len(chunk)
+            written += len(chunk)
+        self.position += written
+        return written
+
+    def finish(self) -> list:
+        """Close the last part, the .zip when the archive was not split, otherwise the next .NNN part
+        Returns:
+            list: paths of all parts in order, the first one gets the metadata. Their checksums are in self.checksums
+        """
+        self._close_part(self._part_path(len(self.parts) + 1) if self.parts else self.zip_path)
+        super().close()
+        return self.parts
+
+    def close(self):
+        """Close without finishing, an unfinished part keeps its temporary name"""
+        if not self.closed:
+            self.handle.close()
+        super().close()
+
+
+class Digest:
+    """SHA-256 and MD5 of the same data, computed in one pass. iRODS computes one of them, depending on the
+    default hash scheme of the server, so the data does not have to be read again for either scheme"""
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.md5.update(data)
+
+    def hexdigest(self) -> str:
+        """Hex SHA-256 of the data"""
+        return self.sha256.hexdigest()
+
+
+def irods_checksum(digest) -> str:
+    """Format a SHA-256 digest like iRODS does: sha2:<base64 digest>. For a Digest the MD5 follows after a space,
+    as the hex digest iRODS uses for MD5, see checksum_schemes"""
+    if isinstance(digest, Digest):
+        return f"{irods_checksum(digest.sha256)} {digest.md5.hexdigest()}"
+    return "sha2:" + base64.b64encode(digest.digest()).decode('ascii')
+
+
+def checksum_schemes(checksum: str) -> dict:
+    """Split a checksum of irods_checksum by scheme
+    Args:
+        checksum: str
+            sha2:<base64 digest>, optionally followed by the hex MD5
+    Returns:
+        dict: checksum in the iRODS format by scheme, 'sha2' and 'md5'
+    """
+    return {'sha2' if value.startswith('sha2:') else 'md5': value for value in checksum.split()}
+
+
+class ConcatReader(io.RawIOBase):
+    """Read only, seekable stream over the parts of a split archive, as if they were one file.
+    Used to read the central directory, which can be spread over the last parts."""
+    def __init__(self, handles: list):
+        super().__init__()
+        self.handles = handles
+        self.starts = []
+        self.size = 0
+        for handle in handles:
+            self.starts.append(self.size)
+            self.size += handle.seek(0, io.SEEK_END)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')
+        read = 0
+        while read < len(view) and self.position < self.size:
+            part = bisect.bisect_right(self.starts, self.position) - 1
+            handle = self.handles[part]
+            handle.seek(self.position - self.starts[part])
+            end = self.starts[part + 1] if part + 1 < len(self.starts) else self.size
+            data = handle.read(min(len(view) - read, end - self.position))
+            if not data:
+                break
+            view[read:read + len(data)] = data
+            read += len(data)
+            self.position += len(data)
+        return read
+
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+        super().close()
+
+
+def verify_archive(fileobj, manifest: list[ZipInfo]) -> bool:
+    """Check the central directory of a written archive against the entries that were written.
+    Only the central directory is read, the data itself is covered by the CRCs and checksums
+    computed while writing.
+    Args:
+        fileobj: file like object
+            seekable stream of the archive, e.g. a ConcatReader
+        manifest: list[ZipInfo]
+            entries as returned by zip_folder
+    Returns:
+        bool: True if every entry is in the central directory with the same CRC, sizes and offset
+    """
+    try:
+        with ZipFile(fileobj, 'r') as zip_file:
+            central_dir = {info.filename: info for info in zip_file.infolist()}
+    except BadZipFile as e:
+        logging.error(f"Can't read the central directory: {e}")
+        return False
+    if len(central_dir) != len(manifest):
+        logging.error(f"Central directory lists {len(central_dir)} entries, {len(manifest)} were written")
+        return False
+    for entry in manifest:
+        info = central_dir.get(entry.filename)
+        if info is None or (info.CRC, info.file_size, info.compress_size, info.compress_type, info.header_offset) != \
+                (entry.CRC, entry.file_size, entry.compress_size, entry.compress_type, entry.header_offset):
+            logging.error(f"Entry {entry.filename} does not match the central directory")
+            return False
+    return True
+
+
+def is_complete_archive(fileobj) -> bool:
+    """Check if an archive was written up to its end, by reading its central directory
+    Args:
+        fileobj: file like object
+            seekable stream of the archive, e.g. a ConcatReader
+    Returns:
+        bool: True if the central directory can be read
+    """
+    try:
+        with ZipFile(fileobj, 'r'):
+            return True
+    except BadZipFile:
+        return False
+
+
+class LocalSplitWriter(SplitWriter):
+    """Zip stream that writes its parts to local files"""
+    def _with_suffix(self, path, suffix: str):
+        return path.with_name(path.name.rsplit('.', 1)[0] + suffix)
+
+    def _open_part(self, path):
+        return open(path, 'wb')
+
+    def _rename_part(self, source, target):
+        os.replace(source, target)
+
+    def discard(self):
+        """Close and remove the parts of an unfinished zip"""
+        self.close()
+        for part in self.parts + [self._temp_path()]:
+            part.unlink(missing_ok=True)
+
+
+def choose_method(path: str, size: int) -> int:
+    """Store or deflate a file, based on its extension or how well a sample from the middle of the file compresses.
+    e.g. TIFF and HDF5 files can be compressed or not, so they are probed
+    Returns:
+        int: ZIP_STORED or ZIP_DEFLATED
+    """
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return ZIP_STORED
+    with open(path, 'rb') as file:
+        file.seek(max(0, size // 2 - PROBE_SIZE // 2))
+        sample = file.read(PROBE_SIZE)
+    if len(sample) == 0:
+        return ZIP_DEFLATED
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - PROBE_MIN_SAVING):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def compress_block(path: str, offset: int, length: int, final: bool, level: int, method):
+    """Read and deflate one block of a file, runs in a thread as zlib releases the GIL.
+    Every block gets its own compressor, non final blocks end with a sync flush so the
+    blocks of a file concatenate to a single valid deflate stream.
+    Args:
+        method: Future
+            result of choose_method for the file, it is submitted before the blocks so it is always
+            running or done when a block starts
+    Returns:
+        tuple: raw data, compressed data
+    """
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(length)
+    if method.result() == ZIP_STORED:
+        return data, data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return data, compressed
+
+
+class ParallelZipWriter:
+    """Writes ZIP64 archives, the files are compressed in blocks on a thread pool and written in order.
+    Every entry uses a data descriptor, so the output stream does not need to be seekable"""
+    def __init__(self, fileobj, num_threads: int = None, compresslevel: int = 6, block_size: int = BLOCK_SIZE,
+                 progress=None):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.num_threads = num_threads or os.cpu_count()
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.position = 0
+        self.entries = []
+        # State of the entry that is being written, entries are written one at a time
+        self.entry_zip64 = False
+        self.entry_read = 0
+
+    def _write(self, data: bytes):
+        self.fileobj.write(data)
+        self.position += len(data)
+
+    def _steps(self, items: list):
+        """Split the items in the steps that are written in order, a directory is a single step
+        and a file one step per block. Empty files consist of one empty block."""
+        for path, zinfo in items:
+            if zinfo.is_dir():
+                yield path, zinfo, 0, 0, True, True
+                continue
+            num_blocks = max(1, -(-zinfo.file_size // self.block_size))
+            for block in range(0, num_blocks):
+                length = self.block_size if block < num_blocks - 1 else zinfo.file_size - block * self.block_size
+                yield path, zinfo, block * self.block_size, length, block == 0, block == num_blocks - 1
+
+    def _start_entry(self, zinfo: ZipInfo, method: int):
+        zinfo.header_offset = self.position
+        if zinfo.is_dir():
+            zinfo.compress_type = ZIP_STORED
+            zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+            self._write(zinfo.FileHeader(False))
+            return
+        zinfo.compress_type = method
+        zinfo.flag_bits |= DATA_DESCRIPTOR_FLAG
+        # Compressed data can be slightly larger than the file
+        self.entry_zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        self.entry_read = 0
+        zinfo.CRC = zinfo.compress_size = 0
+        self._write(zinfo.FileHeader(self.entry_zip64))
+
+    def _write_block(self, zinfo: ZipInfo, data: bytes, compressed: bytes):
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+        self.entry_read += len(data)
+        zinfo.compress_size += len(compressed)
+        self._write(compressed)
+        if self.progress is not None:
+            self.progress(len(data))
+
+    def _finish_entry(self, zinfo: ZipInfo):
+        if not zinfo.is_dir():
+            # The size that was read, a file that changed while zipping is still consistent in the archive
+            zinfo.file_size = self.entry_read
+            if not self.entry_zip64 and (zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT):
+                raise LargeZipFile(f"{zinfo.filename} grew beyond the zip64 limit while zipping")
+            fmt = '<LLQQ' if self.entry_zip64 else '<LLLL'
+            self._write(struct.pack(fmt, DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        self.entries.append(zinfo)
+
+    def write_entries(self, items: list):
+        """Compress and write files and directories
+        Args:
+            items: list
+                (path, ZipInfo) of the entries, in the order of the archive
+        """
+        pending = deque()
+        # Limits the memory use to a few blocks per thread
+        window = self.num_threads * 4
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            method = None
+            for step in self._steps(items):
+                path, zinfo, offset, length, first, final = step
+                future = None
+                if not zinfo.is_dir():
+                    if first:
+                        method = executor.submit(choose_method, path, zinfo.file_size)
+                    future = executor.submit(compress_block, path, offset, length, final, self.compresslevel, method)
+                pending.append((step, method, future))
+                while len(pending) > window:
+                    self._write_step(*pending.popleft())
+            while pending:
+                self._write_step(*pending.popleft())
+
+    def _write_step(self, step: tuple, method, future):
+        _, zinfo, _, _, first, final = step
+        if first:
+            self._start_entry(zinfo, method.result() if future is not None else ZIP_STORED)
+        if future is not None:
+            self._write_block(zinfo, *future.result())
+        if final:
+            self._finish_entry(zinfo)
+
+    def close(self):
+        """Write the central directory, with the zip64 records when needed"""
+        start_dir = self.position
+        for zinfo in self.entries:
+            dt = zinfo.date_time
+            dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+            dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+            zip64_fields = []
+            file_size, compress_size, header_offset = zinfo.file_size, zinfo.compress_size, zinfo.header_offset
+            if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+                zip64_fields += [file_size, compress_size]
+                file_size = compress_size = 0xffffffff
+            if header_offset > ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = 0xffffffff
+            extra = zinfo.extra
+            min_version = DEFAULT_VERSION
+            if zip64_fields:
+                extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) + extra
+                min_version = ZIP64_VERSION
+            try:
+                filename, flag_bits = zinfo.filename.encode('ascii'), zinfo.flag_bits
+            except UnicodeEncodeError:
+                filename, flag_bits = zinfo.filename.encode('utf-8'), zinfo.flag_bits | UTF8_FILENAME_FLAG
+            self._write(struct.pack(structCentralDir, stringCentralDir,
+                                    max(min_version, zinfo.create_version), zinfo.create_system,
+                                    max(min_version, zinfo.extract_version), zinfo.reserved, flag_bits,
+                                    zinfo.compress_type, dostime, dosdate, zinfo.CRC, compress_size, file_size,
+                                    len(filename), len(extra), len(zinfo.comment), 0, zinfo.internal_attr,
+                                    zinfo.external_attr, header_offset) + filename + extra + zinfo.comment)
+        end_dir = self.position
+        count, size, offset = len(self.entries), end_dir - start_dir, start_dir
+        if count > ZIP_FILECOUNT_LIMIT or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+            self._write(struct.pack(structEndArchive64, stringEndArchive64, 44, ZIP64_VERSION, ZIP64_VERSION,
+                                    0, 0, count, count, size, offset))
+            self._write(struct.pack(structEndArchive64Locator, stringEndArchive64Locator, 0, end_dir, 1))
+            count, size, offset = min(count, 0xffff), min(size, 0xffffffff), min(offset, 0xffffffff)
+        self._write(struct.pack(structEndArchive, stringEndArchive, 0, 0, count, count, size, offset, 0))
+
+
+def zip_folder(folder_path: Path, fileobj, scan: ScanResult = None, num_threads: int = None,
+               progress=None) -> list[ZipInfo]:
+    """Write a ZIP64 archive of a folder, or a single file, to a file like object which does not need to be seekable.
+    Entry names are relative to the folder, like the shutil implementation.
+    Files that are compressed already are stored instead of deflated, see choose_method.
+    Args:
+        folder_path: Path
+            folder or file to zip
+        fileobj: file like object
+            stream to write the archive to
+        scan: ScanResult
+            optional, earlier scan of the folder. If not given the folder is scanned
+        num_threads: int
+            number of compression threads, defaults to the number of cpus
+        progress: callable
+            optional, called with the number of bytes of every block that is zipped
+    Returns:
+        list[ZipInfo]: the archive entries, including their CRC
+    """
+    folder_path = Path(folder_path)
+    if scan is None:
+        scan = scan_folder(str(folder_path))
+    root = folder_path.parent if folder_path.is_file() else folder_path
+    # Sorted for a reproducible archive, folders are listed before their content
+    rel_paths = sorted(scan.dirs + [rel_path for rel_path, _ in scan.files])
+    items = [(str(root.joinpath(rel_path)),
+              ZipInfo.from_file(root.joinpath(rel_path), rel_path, strict_timestamps=False)) for rel_path in rel_paths]
+    writer = ParallelZipWriter(fileobj, num_threads, progress=progress)
+    writer.write_entries(items)
+    writer.close()
+    return writer.entries
+
+
+def summarize_methods(entries: list[ZipInfo]) -> str:
+    """Short summary of the stored and deflated files of an archive, for the log"""
+    summary = []
+    for method, name in [(ZIP_STORED, 'stored'), (ZIP_DEFLATED, 'deflated')]:
+        files = [entry for entry in entries if not entry.is_dir() and entry.compress_type == method]
+        size = sum(entry.file_size for entry in files)
+        compressed = sum(entry.compress_size for entry in files)
+        summary.append(f"{name} {len(files)} files ({size / 2**30:.2f}GB -> {compressed / 2**30:.2f}GB)")
+    return ', '.join(summary)
+
+
+def write_crc_report(entries: list[ZipInfo], report_path: Path):
+    """Write the CRC32 of every archived file in the Simple File Verification (sfv) format
+    Args:
+        entries: list[ZipInfo]
+            archive entries
+        report_path: Path
+            location of the .sfv file
+    """
+    with open(report_path, 'w', encoding='UTF-8') as file:
+        for entry in entries:
+            if not entry.is_dir():
+                file.write(f"{entry.filename} {entry.CRC:08X}\n")
+    logging.info(f"CRCs of {len(entries)} entries written to {report_path}")
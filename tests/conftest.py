@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT.joinpath('iRODS_ingest')))
+sys.path.insert(0, str(ROOT.joinpath('benchmarks')))
+
+import fake_irods  # noqa: E402
+import ioperations  # noqa: E402
+
+ZONE = '/testZone/home/test'
+
+
+@pytest.fixture
+def fake_env(tmp_path: Path, monkeypatch) -> dict:
+    """iRODS environment of an empty local stand-in for iRODS, see benchmarks/fake_irods.py"""
+    monkeypatch.setattr(ioperations, 'Session', fake_irods.FakeSession)
+    root = tmp_path.joinpath('irods')
+    fake_irods.reset(str(root), [ZONE])
+    return {'fake_root': str(root), 'irods_zone_name': 'testZone', 'irods_user_name': 'test'}
+
+
+@pytest.fixture
+def fake_session(fake_env: dict) -> fake_irods.FakeSession:
+    return fake_irods.FakeSession(fake_env)
+
+
+def put(session: fake_irods.FakeSession, irods_path: str, data: bytes = b'data'):
+    """Create a data object, and its collections, in the stand-in"""
+    local = session.irods.local(irods_path)
+    local.parent.mkdir(parents=True, exist_ok=True)
+    local.write_bytes(data)
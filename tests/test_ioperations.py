@@ -0,0 +1,25 @@
+"""Catalog queries of ioperations against the local stand-in for iRODS"""
+from conftest import ZONE, put
+from ioperations import get_collection_contents, get_collection_listing
+
+
+def test_collection_contents(fake_session):
+    put(fake_session, f"{ZONE}/target/existing.zip")
+    fake_session.irods.local(f"{ZONE}/target/folder/sub").mkdir(parents=True)
+    put(fake_session, f"{ZONE}/target/folder/file.txt")
+    dataobjects, subcollections = get_collection_contents(fake_session, f"{ZONE}/target")
+    assert dataobjects == {'existing.zip'}
+    assert subcollections == {'folder'}
+    assert get_collection_contents(fake_session, f"{ZONE}/missing") == (set(), set())
+
+
+def test_collection_listing_is_exact(fake_session):
+    # _ is a wildcard in the like pattern, a_b/% also matches the siblings aXb and a_b_c
+    put(fake_session, f"{ZONE}/a_b/top.txt", b'12345')
+    put(fake_session, f"{ZONE}/a_b/sub/deep.txt")
+    put(fake_session, f"{ZONE}/aXb/other.txt")
+    put(fake_session, f"{ZONE}/aXb/sub/other.txt")
+    put(fake_session, f"{ZONE}/a_b_c/sub/other.txt")
+    files, subcollections = get_collection_listing(fake_session, f"{ZONE}/a_b")
+    assert files == {'top.txt': (5, {'good'}), 'sub/deep.txt': (4, {'good'})}
+    assert subcollections == {'sub'}
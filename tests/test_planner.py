@@ -0,0 +1,54 @@
+"""Grouped existence check and sizing of the jobs by plan_tasks, against the local stand-in for iRODS"""
+from pathlib import Path
+
+import pandas as pd
+from ibridges.path import IrodsPath
+
+import fake_irods
+from conftest import ZONE, put
+from helpers import create_task_df
+from ioperations import SessionPool
+from planner import plan_tasks
+
+
+def jobs_of(df: pd.DataFrame, first_row: int = 0) -> list:
+    """Jobs like main plans them, from the rows create_task_df added the task fields to"""
+    return [{**job, '_row': first_row + ind} for ind, job in enumerate(df.to_dict('records'))]
+
+
+def test_existing_paths_are_checked_per_collection(fake_env: dict, tmp_path: Path, monkeypatch):
+    source = tmp_path.joinpath('source')
+    for name in ['zipped', 'uploaded', 'new', 'empty']:
+        source.joinpath(name).mkdir(parents=True)
+    source.joinpath('zipped', 'a.txt').write_bytes(b'12345')
+    source.joinpath('new', 'b.txt').write_bytes(b'123')
+    source.joinpath('file.txt').write_bytes(b'1234567')
+    source.joinpath('other.txt').write_bytes(b'12')
+    session = fake_irods.FakeSession(fake_env)
+    target = IrodsPath(session, f"{ZONE}/target")
+    put(session, f"{ZONE}/target/M5/S1/2025/zipped.zip")
+    # The Year collection exists, only the folder 'uploaded' was uploaded into it
+    put(session, f"{ZONE}/target/M5/S1/2024/uploaded/c.txt")
+    put(session, f"{ZONE}/target/M5/S1/2024/file.txt")
+    rows = pd.DataFrame({'Foldername': ['uploaded', 'new', 'empty', 'file.txt', 'other.txt'],
+                         'NPEC Module': 'Greenhouse', 'System': 'S1', 'Year': [2024, 2024, 2024, 2024, 2023]})
+    zipped_rows = pd.DataFrame({'Foldername': ['zipped'], 'NPEC Module': 'Greenhouse', 'System': 'S1',
+                                'Year': [2025]})
+    jobs = (jobs_of(create_task_df(rows, source, target, ""))
+            + jobs_of(create_task_df(zipped_rows, source, target, tmp_path.joinpath('zips')), len(rows)))
+    assert jobs[0]['_iPath'] == f"{ZONE}/target/M5/S1/2024"
+
+    queries = []
+    query = fake_irods.FakeiRODSSession.query
+    monkeypatch.setattr(fake_irods.FakeiRODSSession, 'query',
+                        lambda self, *columns: queries.append(columns) or query(self, *columns))
+    planned = {job['_row']: job for batch in plan_tasks(jobs, SessionPool(fake_env, None, 1), num_threads=2)
+               for job in batch}
+
+    # Two queries, data objects and subcollections, per target collection instead of one per job
+    assert len(queries) == 2 * 3
+    assert sorted(planned) == list(range(len(jobs)))
+    assert [planned[row]['_status'] for row in [0, 3, 5]] == ['existing ipath'] * 3
+    assert (planned[1]['_status'], planned[1]['_size']) == ('Folder', 3)
+    assert (planned[2]['_status'], planned[2]['_iPath']) == ('Empty folder', '')
+    assert (planned[4]['_status'], planned[4]['_size']) == ('File', 2)
@@ -0,0 +1,45 @@
+"""Symlink policy and failed paths of the scanner"""
+import logging
+import os
+from pathlib import Path
+
+import scanner
+from scanner import iter_scan_paths, scan_folder
+
+
+def test_symlinks(tmp_path: Path, caplog):
+    target = tmp_path.joinpath('target')
+    target.mkdir()
+    target.joinpath('linked.txt').write_bytes(b'1234567')
+    folder = tmp_path.joinpath('folder')
+    folder.joinpath('sub').mkdir(parents=True)
+    folder.joinpath('sub', 'file.txt').write_bytes(b'123')
+    os.symlink(target.joinpath('linked.txt'), folder.joinpath('file_link.txt'))
+    os.symlink(target, folder.joinpath('folder_link'))
+    os.symlink(tmp_path.joinpath('missing'), folder.joinpath('broken_link'))
+    with caplog.at_level(logging.WARNING):
+        scan = scan_folder(str(folder))
+    # Symlinks to files count with the size of their target, the others are skipped and logged
+    assert scan.files == [('file_link.txt', 7), ('sub/file.txt', 3)]
+    assert scan.dirs == ['sub']
+    assert scan.size == 10
+    skipped = '\n'.join(caplog.messages)
+    assert str(folder.joinpath('folder_link')) in skipped and str(folder.joinpath('broken_link')) in skipped
+
+
+def test_failed_path_does_not_stop_the_scan(tmp_path: Path, monkeypatch):
+    for name in ['denied', 'readable']:
+        tmp_path.joinpath(name, 'sub').mkdir(parents=True)
+        tmp_path.joinpath(name, 'sub', 'file.txt').write_bytes(b'123')
+    scan_dir = scanner.scan_dir
+
+    def deny(dir_path: str, *args):
+        if dir_path == str(tmp_path.joinpath('denied', 'sub')):
+            raise PermissionError(f"Permission denied: {dir_path}")
+        return scan_dir(dir_path, *args)
+
+    monkeypatch.setattr(scanner, 'scan_dir', deny)
+    paths = [str(tmp_path.joinpath(name)) for name in ['denied', 'missing.txt', 'readable']]
+    results = dict(iter_scan_paths(paths, 2))
+    assert results[paths[0]] is None and results[paths[1]] is None
+    assert results[paths[2]].files == [('sub/file.txt', 3)]
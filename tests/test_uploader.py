@@ -0,0 +1,125 @@
+"""Uploads of the iRODS workers over objects left behind by an earlier run, against the local stand-in for iRODS"""
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
+
+import pytest
+from ibridges.path import IrodsPath
+
+import fake_irods
+import ioperations
+from conftest import ZONE, put
+from ioperations import I_WORKER, IrodsZipWriter
+from zipwriter import Digest, irods_checksum
+
+
+@pytest.fixture
+def worker(fake_env: dict, fake_session) -> I_WORKER:
+    """iRODS worker that runs in the test process, with the session it would take from its pool"""
+    worker = I_WORKER(fake_env, None, multiprocessing.Event(), None, multiprocessing.Queue(), 0,
+                      checkpoint_size=2**16)
+    worker.session = fake_session
+    return worker
+
+
+@pytest.fixture
+def local_file(tmp_path: Path) -> Path:
+    local_file = tmp_path.joinpath('file.bin')
+    local_file.write_bytes(os.urandom(100000))
+    return local_file
+
+
+def zip_checksum(local_file: Path) -> str:
+    """Checksum of a file as the zippers compute it"""
+    digest = Digest()
+    digest.update(local_file.read_bytes())
+    return irods_checksum(digest)
+
+
+def test_partial_file_is_uploaded_again(worker, local_file: Path, fake_session):
+    # A file has no checksum before its upload, an object of an earlier run can't be trusted
+    put(fake_session, f"{ZONE}/file.bin", local_file.read_bytes()[:1000])
+    worker.uploader(local_file, IrodsPath(fake_session, f"{ZONE}/file.bin"))
+    assert fake_session.irods.local(f"{ZONE}/file.bin").read_bytes() == local_file.read_bytes()
+
+
+def test_partial_zip_is_uploaded_again(worker, local_file: Path, fake_session):
+    checksum = zip_checksum(local_file)
+    put(fake_session, f"{ZONE}/file.bin", local_file.read_bytes()[:1000])
+    assert worker.uploader(local_file, IrodsPath(fake_session, f"{ZONE}/file.bin"), checksum=checksum) == checksum
+    assert fake_session.irods.local(f"{ZONE}/file.bin").read_bytes() == local_file.read_bytes()
+
+
+def test_complete_zip_is_kept(worker, local_file: Path, fake_session, monkeypatch):
+    checksum = zip_checksum(local_file)
+    put(fake_session, f"{ZONE}/file.bin", local_file.read_bytes())
+    monkeypatch.setattr(fake_session.irods_session.data_objects, 'open',
+                        lambda *args, **kwargs: pytest.fail("a complete upload is uploaded again"))
+    assert worker.uploader(local_file, IrodsPath(fake_session, f"{ZONE}/file.bin"), checksum=checksum) == checksum
+
+
+def test_big_file_interrupted_before_its_first_checkpoint(worker, tmp_path: Path, fake_session):
+    local_file = tmp_path.joinpath('big.bin')
+    local_file.write_bytes(os.urandom(5 * 2**16))
+    put(fake_session, f"{ZONE}/big.bin", local_file.read_bytes()[:30000])
+    worker.uploader(local_file, IrodsPath(fake_session, f"{ZONE}/big.bin"))
+    assert fake_session.irods.local(f"{ZONE}/big.bin").read_bytes() == local_file.read_bytes()
+
+
+def test_big_file_continues_at_its_checkpoint(worker, tmp_path: Path, fake_session):
+    local_file = tmp_path.joinpath('big.bin')
+    data = os.urandom(5 * 2**16)
+    local_file.write_bytes(data)
+    # Written past the checkpoint before the interruption
+    put(fake_session, f"{ZONE}/big.bin", data[:2**17] + b'\0' * 1000)
+    worker.uploader(local_file, IrodsPath(fake_session, f"{ZONE}/big.bin"),
+                    resume=(2**17, hashlib.sha256(data[:2**17]).hexdigest()))
+    assert fake_session.irods.local(f"{ZONE}/big.bin").read_bytes() == data
+
+
+@pytest.fixture
+def split_stream(worker, tmp_path: Path, fake_session, monkeypatch) -> tuple:
+    """Folder that is streamed in parts of 64KB, and its zip in iRODS"""
+    monkeypatch.setattr(IrodsZipWriter.__init__, '__defaults__', (2**16,))
+    # The CRC report goes to the logs of a run
+    monkeypatch.setattr(ioperations, 'write_crc_report', lambda *args: None)
+    folder = tmp_path.joinpath('plot1')
+    folder.mkdir()
+    for number in range(3):
+        folder.joinpath(f"{number}.bin").write_bytes(os.urandom(50000))
+    return folder, IrodsPath(fake_session, f"{ZONE}/plot1.zip")
+
+
+def test_split_stream_is_not_streamed_again(worker, split_stream: tuple, monkeypatch):
+    folder, irods_path = split_stream
+    parts, checksums = worker.stream_upload(folder, irods_path)
+    assert [str(part) for part in parts] == [f"{irods_path}.{number:03d}" for number in range(1, len(parts) + 1)]
+    assert len(parts) > 1 and None not in checksums
+
+    monkeypatch.setattr(I_WORKER, 'stream_uploader', lambda *args: pytest.fail("streamed again"))
+    assert [str(part) for part in worker.stream_upload(folder, irods_path)[0]] == [str(part) for part in parts]
+
+
+def test_interrupted_split_stream_is_streamed_again(worker, split_stream: tuple, fake_session):
+    folder, irods_path = split_stream
+    parts, _ = worker.stream_upload(folder, irods_path)
+    # The last part, with the central directory, was still written under its temporary name
+    fake_session.irods.local(str(parts[-1])).unlink()
+    assert worker.streamed_parts(irods_path) == []
+    assert len(worker.stream_upload(folder, irods_path)[0]) == len(parts)
+
+
+@pytest.fixture
+def md5_server(monkeypatch):
+    """The server computes MD5 checksums, the default hash scheme of older iRODS versions"""
+    monkeypatch.setattr(fake_irods.FakeDataObjectManager, 'chksum',
+                        lambda self, path, **options: hashlib.md5(self.irods.local(path).read_bytes()).hexdigest())
+
+
+def test_uploads_are_verified_with_md5(worker, local_file: Path, split_stream: tuple, md5_server, monkeypatch):
+    checksum = worker.uploader(local_file, IrodsPath(worker.session, f"{ZONE}/file.bin"))
+    assert checksum.split()[1] == hashlib.md5(local_file.read_bytes()).hexdigest()
+    # Streamed zips have no local file, their MD5 is computed while they are written
+    folder, irods_path = split_stream
+    assert None not in worker.stream_upload(folder, irods_path)[1]
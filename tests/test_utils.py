@@ -0,0 +1,14 @@
+"""Parts of multipart zips found by check_for_multipart_zip"""
+from pathlib import Path
+
+from utils import check_for_multipart_zip
+
+
+def test_only_parts_of_the_zip_are_found(tmp_path: Path):
+    for name in ['plot1.zip.001', 'plot1.zip.002', 'plot1.z01', 'plot1.zip', 'plot1.v2.zip', 'plot1.zip.part',
+                 'plot1.txt', 'plot10.zip.001']:
+        tmp_path.joinpath(name).write_bytes(b'')
+    parts = [tmp_path / name for name in ['plot1.z01', 'plot1.zip', 'plot1.zip.001', 'plot1.zip.002']]
+    assert check_for_multipart_zip(str(tmp_path / 'plot1.zip')) == parts
+    assert check_for_multipart_zip(str(tmp_path / 'plot1.zip.001')) == parts
+    assert check_for_multipart_zip(str(tmp_path / 'plot2.zip')) == []
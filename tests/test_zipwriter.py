@@ -0,0 +1,101 @@
+"""Round trip tests of the builtin zip engine: the archives are read back with the zipfile module of python"""
+import hashlib
+import os
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+
+import zipwriter
+from zipwriter import ConcatReader, LocalSplitWriter, irods_checksum, verify_archive, zip_folder
+
+
+@pytest.fixture
+def folder(tmp_path: Path) -> Path:
+    """Folder with compressible, incompressible, empty and non-ascii files and an empty subfolder"""
+    folder = tmp_path.joinpath('data')
+    folder.joinpath('sub', 'deeper').mkdir(parents=True)
+    folder.joinpath('empty_dir').mkdir()
+    folder.joinpath('text.txt').write_bytes(b'compressible line\n' * 20000)
+    folder.joinpath('sub', 'random.bin').write_bytes(os.urandom(300000))
+    folder.joinpath('sub', 'deeper', 'empty.txt').write_bytes(b'')
+    folder.joinpath('sub', 'ümlaut.txt').write_bytes(b'utf-8 name')
+    return folder
+
+
+def zip_to_disk(folder: Path, zip_path: Path, part_size: int) -> tuple:
+    writer = LocalSplitWriter(zip_path, part_size)
+    try:
+        entries = zip_folder(folder, writer, num_threads=4)
+        parts = writer.finish()
+    finally:
+        writer.close()
+    return parts, writer.checksums, entries
+
+
+def concatenate(parts: list, target: Path) -> Path:
+    with open(target, 'wb') as out:
+        for part in parts:
+            out.write(part.read_bytes())
+    return target
+
+
+def check_contents(zip_path: Path, folder: Path):
+    with ZipFile(zip_path) as zip_file:
+        assert zip_file.testzip() is None
+        names = set(zip_file.namelist())
+        expected = {path.relative_to(folder).as_posix() + ('/' if path.is_dir() else '')
+                    for path in folder.rglob('*')}
+        assert names == expected
+        for path in folder.rglob('*'):
+            if path.is_file():
+                assert zip_file.read(path.relative_to(folder).as_posix()) == path.read_bytes()
+
+
+def test_single_part(folder: Path, tmp_path: Path):
+    zip_path = tmp_path.joinpath('data.zip')
+    parts, checksums, entries = zip_to_disk(folder, zip_path, 2**30)
+    assert parts == [zip_path]
+    assert not zip_path.with_suffix('.zip.part').exists()
+    check_contents(zip_path, folder)
+    with ConcatReader([open(zip_path, 'rb')]) as reader:
+        assert verify_archive(reader, entries)
+
+
+def test_split_parts_concatenate_to_the_archive(folder: Path, tmp_path: Path):
+    zip_path = tmp_path.joinpath('data.zip')
+    parts, checksums, entries = zip_to_disk(folder, zip_path, 2**16)
+    assert len(parts) > 2
+    assert parts == [tmp_path.joinpath(f"data.zip.{number:03d}") for number in range(1, len(parts) + 1)]
+    assert not zip_path.exists()
+    assert all(part.stat().st_size == 2**16 for part in parts[:-1])
+    for part, checksum in zip(parts, checksums):
+        data = part.read_bytes()
+        assert checksum == f"{irods_checksum(hashlib.sha256(data))} {hashlib.md5(data).hexdigest()}"
+    with ConcatReader([open(part, 'rb') for part in parts]) as reader:
+        assert verify_archive(reader, entries)
+    check_contents(concatenate(parts, tmp_path.joinpath('restored.zip')), folder)
+
+
+def test_zip64_records(folder: Path, tmp_path: Path, monkeypatch):
+    # With a low limit the entries, offsets and central directory need the zip64 records of a >4GB archive
+    monkeypatch.setattr(zipwriter, 'ZIP64_LIMIT', 1024)
+    zip_path = tmp_path.joinpath('data.zip')
+    parts, checksums, entries = zip_to_disk(folder, zip_path, 2**16)
+    restored = concatenate(parts, tmp_path.joinpath('restored.zip'))
+    data = restored.read_bytes()
+    assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+    check_contents(restored, folder)
+    with ZipFile(restored) as zip_file:
+        infos = {info.filename: info for info in zip_file.infolist()}
+    for entry in entries:
+        info = infos[entry.filename]
+        assert (info.CRC, info.file_size, info.header_offset) == (entry.CRC, entry.file_size, entry.header_offset)
+
+
+def test_verify_archive_detects_a_wrong_entry(folder: Path, tmp_path: Path):
+    zip_path = tmp_path.joinpath('data.zip')
+    parts, checksums, entries = zip_to_disk(folder, zip_path, 2**30)
+    entries[0].CRC ^= 1
+    with ConcatReader([open(zip_path, 'rb')]) as reader:
+        assert not verify_archive(reader, entries)